@@ -5,10 +5,25 @@ python. An additional goal is to have the reports be managed by model instances
 report that can be done in the backend).
 """
 from django import forms
+from django.db.models.aggregates import Aggregate
+try:
+    from django.db.models.constants import LOOKUP_SEP
+except ImportError:
+    # Django < 1.5
+    from django.db.models.sql.constants import LOOKUP_SEP
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.fields.related import RelatedField
 from filtercontrols import *
 from outputformats import *
+from settings import REPORT_ROW_BATCH_SIZE, REPORT_PREBUILT_EXPORT_FORMATS, REPORT_DATABASE, \
+    REPORT_SLOW_QUEUE, REPORT_STATEMENT_TIMEOUT
 import datetime
+import decimal
+import json
+import re
+import sys
+import threading
+import uuid
 
 # Pulled from vitalik's Django-reporting
 def get_model_field(model, name):
@@ -46,6 +61,333 @@ def get_lookup_field(model, original, lookup):
     next_lookup = '__'.join(parts[1:])
     return get_lookup_field(rel_model, original, next_lookup)
 
+## Django model field type (see Field.get_internal_type) -> report column type
+FIELD_COLUMN_TYPES = {
+    'AutoField': 'integer',
+    'BigIntegerField': 'integer',
+    'IntegerField': 'integer',
+    'PositiveIntegerField': 'integer',
+    'PositiveSmallIntegerField': 'integer',
+    'SmallIntegerField': 'integer',
+    'FloatField': 'float',
+    'DecimalField': 'decimal',
+    'BooleanField': 'boolean',
+    'NullBooleanField': 'boolean',
+    'DateField': 'date',
+    'DateTimeField': 'datetime',
+    'TimeField': 'time',
+    'CharField': 'text',
+    'CommaSeparatedIntegerField': 'text',
+    'EmailField': 'text',
+    'FilePathField': 'text',
+    'FileField': 'text',
+    'ImageField': 'text',
+    'GenericIPAddressField': 'text',
+    'IPAddressField': 'text',
+    'SlugField': 'text',
+    'TextField': 'text',
+    'URLField': 'text',
+}
+
+def get_field_column_type(field):
+    """
+    Gets the report column type of a Django model field. Relations take the type of the field they point to, which
+    is what values_list returns for them.
+
+    :param field: A subclass of django.db.models.fields.Field
+    :return:  A column type (e.g. "integer", see Report.column_types), or None if unknown.
+    """
+    if isinstance(field, RelatedField):
+        return get_field_column_type(field.rel.get_related_field())
+    return FIELD_COLUMN_TYPES.get(field.get_internal_type())
+
+NAMED_PARAM_RE = re.compile(r'%%|%\((\w+)\)s')
+
+def compile_statement(sql):
+    """
+    Rewrites the named placeholders of a statement (e.g. "%(age)s") to positional %s placeholders, which every
+    database backend takes (sqlite's only takes those). Escaped percent signs ("%%") are left as they are.
+
+    :param sql: A SQL statement with named placeholders in python syntax.
+    :return:  A tuple of the SQL with positional placeholders, and a list of the placeholder names in order.
+    """
+    names = []
+    def replace(match):
+        if match.group(1) is None:
+            return match.group(0)
+        names.append(match.group(1))
+        return '%s'
+    return NAMED_PARAM_RE.sub(replace, sql), names
+
+def to_datetime(value):
+    return forms.DateTimeField().to_python(value)
+
+def to_boolean(value):
+    return {'1': True, '0': False}.get(value)
+
+## query_params datatype -> conversion of (string) filter values to the type they are bound to SQL parameters with
+PARAM_DATATYPE_CONVERTERS = {
+    'datetime': to_datetime,
+    'boolean': to_boolean,
+}
+
+def get_named_aggregates(aggregates):
+    """
+    Lists aggregates given by name, see QuerySetReport.aggregates.
+
+    :param aggregates: A dictionary of Django aggregates by name, or a list of (name, aggregate) tuples.
+    :return:  A list of (name, aggregate) tuples, in name order for a dictionary.
+    """
+    if not aggregates:
+        return []
+    if isinstance(aggregates, dict):
+        return sorted(aggregates.items())
+    return list(aggregates)
+
+def quote_pivot_value(value, connection):
+    """
+    Renders a pivot value as an SQL literal. Aggregates can't take query parameters (in Django 1.5), so the value is
+    escaped into the SQL instead.
+
+    :param value: A number, date, datetime or string.
+    :param connection: The database connection the query runs on.
+    :return:  The SQL literal.
+    """
+    if isinstance(value, bool):
+        raise ValueError('Boolean pivot values are not supported.')
+    if isinstance(value, (int, long, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat(' ') if isinstance(value, datetime.datetime) else value.isoformat()
+    value = unicode(value).replace("'", "''")
+    if connection.vendor == 'mysql':
+        value = value.replace('\\', '\\\\')
+    # the query is executed with parameters, a literal % has to be doubled
+    return "'%s'" % value.replace('%', '%%')
+
+class PivotColumn(object):
+    """
+    The column an aggregate of a pivot column (see PivotAggregate) runs over: the aggregated column where the pivot
+    column has the pivot value, and NULL, which aggregates skip, elsewhere.
+    """
+    def __init__(self, col, pivot_col, value):
+        self.col = col
+        self.pivot_col = pivot_col
+        self.value = value
+
+    def quote(self, col, qn):
+        if isinstance(col, (list, tuple)):
+            return '.'.join([qn(c) for c in col])
+        return col
+
+    def as_sql(self, qn, connection):
+        return 'CASE WHEN %s = %s THEN %s ELSE NULL END' % (self.quote(self.pivot_col, qn),
+                                                            quote_pivot_value(self.value, connection),
+                                                            self.quote(self.col, qn))
+
+class PivotAggregate(Aggregate):
+    """
+    Conditional aggregation: a Django aggregate, e.g. Sum('price'), over only the rows where the pivot lookup has the
+    pivot value, e.g. SUM(CASE WHEN department = 'Mens' THEN price ELSE NULL END).
+    """
+    def __init__(self, aggregate, pivot, value):
+        super(PivotAggregate, self).__init__(aggregate.lookup, **aggregate.extra)
+        self.name = aggregate.name
+        self.pivot = pivot
+        self.value = value
+
+    def add_to_query(self, query, alias, col, source, is_summary):
+        # resolve the pivot lookup the way Query.add_aggregate resolves the aggregated one, joins included
+        field, target, opts, join_list, last, extra = query.setup_joins(
+            self.pivot.split(LOOKUP_SEP), query.get_meta(), query.get_initial_alias(), False)
+        pivot_col, target, join_list = query.trim_joins(target, join_list, last, False)
+        if hasattr(query, 'promote_joins'):
+            query.promote_joins(join_list, True)
+        else:
+            # Django < 1.5
+            for join_alias in join_list:
+                query.promote_alias(join_alias, unconditional=True)
+        super(PivotAggregate, self).add_to_query(query, alias, PivotColumn(col, (join_list[-1], pivot_col), self.value),
+                                                 source, is_summary)
+
+class QueryCostExceeded(Exception):
+    """
+    Raised when building a report whose query is estimated to exceed the report's limits, see
+    Report.check_query_cost.
+    """
+    pass
+
+def explain_query(connection, sql, params=None):
+    """
+    Asks the database for its estimate of a query, with EXPLAIN. Only PostgreSQL (rows and cost) and MySQL (rows)
+    give estimates.
+
+    :param connection: The database connection the query would run on.
+    :param sql: The SQL of the query.
+    :param params: The parameters of the query, or None if they are in the SQL already.
+    :return:  A dictionary with the estimated "rows" and "cost" (None if unknown), or None if there's no estimate.
+    """
+    if connection.vendor not in ('postgresql', 'mysql'):
+        return None
+    sql = sql.strip().rstrip(';')
+    cursor = connection.cursor()
+    try:
+        if connection.vendor == 'postgresql':
+            sql = 'EXPLAIN (FORMAT JSON) ' + sql
+        else:
+            sql = 'EXPLAIN ' + sql
+        if params is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, params)
+        if connection.vendor == 'postgresql':
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+            return {'rows': plan[0]['Plan']['Plan Rows'], 'cost': plan[0]['Plan']['Total Cost']}
+        # MySQL estimates the rows examined per table, which multiply across a join
+        columns = [column[0] for column in cursor.description]
+        rows = 1
+        for row in cursor.fetchall():
+            rows *= dict(zip(columns, row)).get('rows') or 1
+        return {'rows': rows, 'cost': None}
+    finally:
+        cursor.close()
+
+def set_statement_timeout(connection, milliseconds, rollback=False):
+    """
+    Limits how long the database may run each statement on a connection for. Only PostgreSQL and MySQL (5.7+,
+    SELECTs only) support this, it is ignored on other backends.
+
+    :param connection: A database connection.
+    :param milliseconds: The timeout, or None to go back to the timeout configured for the server (or role).
+    :param rollback: Whether to roll back the transaction of the connection first. After a statement fails, e.g. by
+                     running into the timeout, PostgreSQL runs nothing else in the transaction until it is rolled back.
+    """
+    if connection.vendor == 'postgresql':
+        sql = milliseconds and 'SET statement_timeout = %d' % milliseconds or 'RESET statement_timeout'
+    elif connection.vendor == 'mysql':
+        sql = 'SET SESSION max_execution_time = %s' % (milliseconds and '%d' % milliseconds or 'DEFAULT')
+    else:
+        return
+    if rollback:
+        if hasattr(connection, 'rollback'):
+            connection.rollback()
+        else:
+            # Django < 1.4
+            connection._rollback()
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql)
+    finally:
+        cursor.close()
+
+class CountingIterator(object):
+    """
+    Iterates over rows, counting them as they go by.
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            row = next(self.rows)
+        except StopIteration:
+            self.exhausted = True
+            raise
+        self.count += 1
+        return row
+
+class LazyRowCount(object):
+    """
+    An aggregate value holding the number of rows of a report. Once the rows (a CountingIterator) have been iterated
+    over to the end, that's the number of rows that went by. Asked for before then, it counts the queryset in the
+    database, once.
+
+    Output formats write the aggregates before the rows, so resolve them first (see resolve_aggregates). Left as is,
+    it still renders as its value.
+    """
+    def __init__(self, rows, queryset):
+        self.rows = rows
+        self.queryset = queryset
+        self.count = None
+
+    def get_value(self):
+        if self.rows.exhausted:
+            return self.rows.count
+        if self.count is None:
+            self.count = self.queryset.count()
+        return self.count
+
+    def __int__(self):
+        return self.get_value()
+
+    def __float__(self):
+        return float(self.get_value())
+
+    def __unicode__(self):
+        return unicode(self.get_value())
+
+    def __str__(self):
+        return str(self.get_value())
+
+    def __eq__(self, other):
+        return self.get_value() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<LazyRowCount: %r>' % self.get_value()
+
+class PendingAggregates(object):
+    """
+    The aggregates of a report while they're still being queried in another thread (see
+    SQLReport.start_aggregate_data). They behave like the list of (name, value) tuples they will be, reading them
+    waits for the query, and raises what it raised.
+    """
+    def __init__(self, wait):
+        self.wait = wait
+
+    def get_value(self):
+        aggregates, error = self.wait()
+        if error:
+            raise error[0], error[1], error[2]
+        return aggregates
+
+    def __iter__(self):
+        return iter(self.get_value())
+
+    def __len__(self):
+        return len(self.get_value())
+
+    def __getitem__(self, val):
+        return self.get_value()[val]
+
+    def __eq__(self, other):
+        return self.get_value() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<PendingAggregates: %r>' % self.get_value()
+
+def resolve_aggregates(aggregates):
+    """
+    Replaces the lazy values (see LazyRowCount) in report aggregates by what they evaluate to. Call it after the rows
+    have been iterated over, so the values don't have to be queried for.
+
+    :param aggregates: The aggregates, as returned by Report.get_rows.
+    :return:  A list of (name, value) tuples.
+    """
+    return [(name, value.get_value() if isinstance(value, LazyRowCount) else value) for name, value in aggregates]
+
 class Report(object):
     """
     An abstract reportengine report.  Concrete report types inherit from this.  Override get_rows to make this concrete.
@@ -62,12 +404,30 @@ class Report(object):
     labels = None
     per_page=100
     can_show_all=True
-    output_formats=[AdminOutputFormat(),CSVOutputFormat()]
+    output_formats=[AdminOutputFormat(),JSONOutputFormat(),NDJSONOutputFormat()]
+    if PARQUET_AVAILABLE:
+        output_formats.append(ParquetOutputFormat())
+    if XLSX_AVAILABLE:
+        output_formats.append(XLSXOutputFormat())
+    # generate_report defaults to the last format, which stays CSV, or XLS if xlwt is installed
+    output_formats.append(CSVOutputFormat())
     if XLS_AVAILABLE:
         output_formats.append(XLSOutputFormat())
     allow_unspecified_filters = False
     date_field = None  # if specified will lookup for this date field. .this is currently limited to queryset based lookups
     default_mask = {}  # a dict of filter default values. Can be callable
+    cache_ttl = None  # seconds for which a finished report request is reused for requests with the same params
+    prebuilt_export_formats = REPORT_PREBUILT_EXPORT_FORMATS  # output format slugs exported once a request is built
+    # a dict of label -> column type, one of "text", "integer", "float", "decimal", "boolean", "date", "datetime" or
+    # "time". Output formats compile their cell conversions from these, see get_column_types
+    column_types = {}
+    using = None  # alias of the database the report queries run against, see get_database
+    # limits on the database's estimate of the report query (see get_query_estimate), checked before it is built
+    max_estimated_rows = None
+    max_estimated_cost = None
+    cost_guard_action = 'reject'  # for reports over the limits: "reject", "slow_queue" or "timeout"
+    slow_queue = REPORT_SLOW_QUEUE  # celery queue the "slow_queue" action sends the build to
+    statement_timeout = REPORT_STATEMENT_TIMEOUT  # milliseconds, for the "timeout" action
 
     # TODO add charts = [ {'name','type e.g. bar','data':(0,1,3) cols in table}]
     # then i can auto embed the charts at the top of the report based upon that data..
@@ -85,6 +445,75 @@ class Report(object):
             m[k] =  callable(v) and v() or v
         return m
 
+    def get_database(self):
+        """
+        Picks the database the queries of the report run against: using, or the REPORT_DATABASE setting. Override
+        this to route reports to read replicas by other means. Report results are always written to the database
+        of the reportengine models.
+
+        :return:  A database alias, or None for the default (for querysets, the one the database routers pick).
+        """
+        return self.using or REPORT_DATABASE
+
+    def get_connection(self):
+        """
+        :return:  The database connection the report queries run on, or None if the report doesn't query a database.
+        """
+        return None
+
+    def get_query_estimate(self, filters, order_by=None):
+        """
+        Estimates the cost of the report query, without running it.
+
+        :param filters: The parameters by which this report should be filtered.
+        :param order_by:  The field by which this report should be ordered.
+        :return:  A dictionary with the estimated "rows" and "cost", see explain_query, or None if there's no estimate.
+        """
+        return None
+
+    def check_query_cost(self, filters, order_by=None):
+        """
+        Compares the estimate of the report query with max_estimated_rows and max_estimated_cost.
+
+        :param filters: The parameters by which this report should be filtered.
+        :param order_by:  The field by which this report should be ordered.
+        :return:  A tuple of cost_guard_action and a message, or (None, None) if the query is within the limits.
+        """
+        if self.max_estimated_rows is None and self.max_estimated_cost is None:
+            return None, None
+        estimate = self.get_query_estimate(filters, order_by)
+        if not estimate:
+            return None, None
+        if self.max_estimated_rows is not None and estimate['rows'] is not None \
+                and estimate['rows'] > self.max_estimated_rows:
+            return self.cost_guard_action, 'This report would return about %d rows, more than the %d allowed. ' \
+                                           'Please narrow it down with the filters.' % (estimate['rows'],
+                                                                                          self.max_estimated_rows)
+        if self.max_estimated_cost is not None and estimate['cost'] is not None \
+                and estimate['cost'] > self.max_estimated_cost:
+            return self.cost_guard_action, 'This report is too expensive to run. ' \
+                                           'Please narrow it down with the filters.'
+        return None, None
+
+    def set_statement_timeout(self, milliseconds, rollback=False):
+        """
+        Limits how long the database may run each statement of the report for, see set_statement_timeout.
+
+        :param milliseconds: The timeout, or None to go back to the configured one.
+        :param rollback: Whether to roll back the transaction first, after a failed statement.
+        """
+        connection = self.get_connection()
+        if connection is not None:
+            set_statement_timeout(connection, milliseconds, rollback)
+
+    def get_column_types(self):
+        """
+        Gets the type of every column, in the order of labels, from column_types.
+
+        :return:  A list with a column type, or None where it is unknown, per label.
+        """
+        return [self.column_types.get(label) for label in self.labels or ()]
+
     def get_filter_form(self, data):
         """
         Returns a form with data.
@@ -96,12 +525,14 @@ class Report(object):
         return form
 
     # CONSIDER maybe an "update rows"?
-    # CONSIDER should the resultant rows be a generator instead of a list?
     # CONSIDER should paging be dealt with here to more intelligently handle aggregates?
     def get_rows(self,filters={},order_by=None):
         """
         Given filter parameters and an order by field, this returns the actual rows of the report.
 
+        The rows may be any iterable, including a generator. Consumers only iterate over them once, so rows
+        can be produced lazily and never held in memory all at once.
+
         :param filters: The parameters by which this report should be filtered.
         :param order_by:  The field by which this report should be ordered.
         :return:  A tuple (resultant rows, metadata)
@@ -127,6 +558,9 @@ class QuerySetReport(Report):
     list_filter must contain either ModelFields or FilterControls
     """
     list_filter = []
+    # aggregates computed over the filtered queryset, by name, e.g. {'revenue': Sum('total'), 'avg_price': Avg('price')}.
+    # They come after the total, in name order (use a list of (name, aggregate) tuples to set the order)
+    aggregates = None
 
     def get_filter_form(self, data):
         """
@@ -159,6 +593,47 @@ class QuerySetReport(Report):
         form.full_clean()
         return form
     
+    def get_column_types(self):
+        """
+        Gets the column types from column_types, and for columns not listed there, from the model fields the labels
+        look up (see get_lookup_field).
+
+        :return:  A list with a column type, or None where it is unknown, per label.
+        """
+        column_types = super(QuerySetReport, self).get_column_types()
+        if None not in column_types:
+            return column_types
+        queryset = self.queryset
+        if queryset is None:
+            queryset = self.get_queryset({}, None)
+        model = queryset.model
+        for index, label in enumerate(self.labels):
+            if column_types[index] is None:
+                try:
+                    field, field_model = get_lookup_field(model, model, label)
+                except FieldDoesNotExist:
+                    continue # e.g. an annotation
+                column_types[index] = get_field_column_type(field)
+        return column_types
+
+    def get_connection(self):
+        """
+        :return:  The connection of the database from get_database, or the one the routers pick for reading the model.
+        """
+        from django.db import connections, router
+        queryset = self.queryset
+        if queryset is None:
+            queryset = self.get_queryset({}, None)
+        return connections[self.get_database() or router.db_for_read(queryset.model)]
+
+    def get_query_estimate(self, filters, order_by=None):
+        from django.db import connections
+        qs = self.get_queryset(filters, order_by)
+        if self.get_database():
+            qs = qs.using(self.get_database())
+        sql, params = qs.values_list(*self.labels).query.sql_with_params()
+        return explain_query(connections[qs.db], sql, params)
+
     def get_queryset(self, filters, order_by, queryset=None):
         """
         Given filters, an order_by and an optional query set, this returns a queryset for this report.  Override this
@@ -181,13 +656,36 @@ class QuerySetReport(Report):
         Given the rows and order_by value, this returns the actual report tuple.  This needn't be overriden by
         subclasses unless special functionality is needed.  Instead, consider overriding `get_queryset.`
 
+        The rows are streamed with QuerySet.iterator(), so the queryset result cache is never filled. The queryset
+        (and its aggregates) runs on the database from get_database, if any.
+
+        The aggregates are the "total", followed by those of the aggregates attribute (see get_aggregate_data). The
+        total is a LazyRowCount: once the rows have been iterated over, it is the number of rows that went by, and
+        only if it's asked for before then is the queryset counted in the database.
+
         :param filters:   A dictionary of field/value pairs that the report can be filtered on.
         :param order_by:  The field or statement by which this queryset should be ordered.
 
-        :return:  A tuple of rows and metadata.
+        :return:  A tuple of a row iterator and metadata.
         """
         qs = self.get_queryset(filters, order_by)
-        return qs.values_list(*self.labels),(("total",qs.count()),)
+        if self.get_database():
+            qs = qs.using(self.get_database())
+        rows = CountingIterator(qs.values_list(*self.labels).iterator())
+        return rows,(("total",LazyRowCount(rows, qs)),) + tuple(self.get_aggregate_data(qs))
+
+    def get_aggregate_data(self, queryset):
+        """
+        Evaluates aggregates over a queryset, in a single queryset.aggregate() call.
+
+        :param queryset: The filtered queryset of the report, see get_queryset.
+        :return:  A list of (name, value) tuples, in the order of aggregates.
+        """
+        aggregates = get_named_aggregates(self.aggregates)
+        if not aggregates:
+            return []
+        values = queryset.aggregate(**dict(aggregates))
+        return [(name, values[name]) for name, aggregate in aggregates]
 
 class ModelReport(QuerySetReport):
     """
@@ -217,6 +715,105 @@ class ModelReport(QuerySetReport):
             queryset = self.model.objects.all()
         return super(ModelReport, self).get_queryset(filters, order_by, queryset)
 
+class GroupedQuerySetReport(QuerySetReport):
+    """
+    A report of a queryset grouped by the group_by fields, with the annotations of every group, in a single
+    values(*group_by).annotate(**annotations) query. The labels are the group_by fields followed by the annotations.
+
+    If pivot is set, the annotations are instead split into a column per pivot value, with conditional aggregation
+    (see PivotAggregate), still in the same query. With more than one annotation, those columns are labeled
+    "<pivot label> <annotation>".
+
+    The aggregates attribute still applies to the whole filtered queryset, and the total is the number of groups.
+    """
+    group_by = ()
+    # aggregates of every group, by name, e.g. {'revenue': Sum('price')}. Listed in name order, unless a list of
+    # (name, aggregate) tuples is used
+    annotations = None
+    pivot = None  # lookup of the field whose values become columns, e.g. 'sale__customer__last_name'
+    pivot_values = ()  # values of pivot that get columns, or (value, label) tuples
+
+    def get_pivot_values(self):
+        """
+        :return:  A list of (value, label) tuples, see pivot_values.
+        """
+        return [value if isinstance(value, (list, tuple)) else (value, unicode(value)) for value in self.pivot_values]
+
+    def get_columns(self):
+        """
+        Lists the annotated columns of the report.
+
+        :return:  A list of (label, alias, aggregate) tuples, in column order.
+        """
+        annotations = get_named_aggregates(self.annotations)
+        if not self.pivot:
+            return [(name, name, aggregate) for name, aggregate in annotations]
+        columns = []
+        for index, (value, label) in enumerate(self.get_pivot_values()):
+            for name, aggregate in annotations:
+                if len(annotations) > 1:
+                    column_label = u'%s %s' % (label, name)
+                else:
+                    column_label = label
+                # pivot labels can be anything, so they don't make for query aliases
+                columns.append((column_label, 'pivot_%d_%s' % (index, name), PivotAggregate(aggregate, self.pivot, value)))
+        return columns
+
+    @property
+    def labels(self):
+        return list(self.group_by) + [label for label, alias, aggregate in self.get_columns()]
+
+    def get_ordering(self, order_by=None):
+        """
+        :param order_by: The label by which the report should be ordered, optionally prefixed with "-".
+        :return:  The order_by arguments of the grouped queryset, by default the group_by fields.
+        """
+        if not order_by:
+            return list(self.group_by)
+        aliases = dict((label, alias) for label, alias, aggregate in self.get_columns())
+        label = order_by.lstrip('-')
+        return [order_by[:len(order_by) - len(label)] + aliases.get(label, label)]
+
+    def get_grouped_queryset(self, queryset, order_by=None):
+        """
+        Groups and annotates a queryset.
+
+        :param queryset: The filtered queryset of the report, see get_queryset.
+        :param order_by: The label by which the report should be ordered.
+        :return:  A values_list queryset of the report rows.
+        """
+        columns = self.get_columns()
+        queryset = queryset.values(*self.group_by).annotate(**dict((alias, aggregate)
+                                                                   for label, alias, aggregate in columns))
+        # the ordering always has to be set, a default model ordering would end up in the GROUP BY
+        queryset = queryset.order_by(*self.get_ordering(order_by))
+        return queryset.values_list(*(list(self.group_by) + [alias for label, alias, aggregate in columns]))
+
+    def get_query_estimate(self, filters, order_by=None):
+        from django.db import connections
+        qs = self.get_queryset(filters, None)
+        if self.get_database():
+            qs = qs.using(self.get_database())
+        sql, params = self.get_grouped_queryset(qs, order_by).query.sql_with_params()
+        return explain_query(connections[qs.db], sql, params)
+
+    def get_rows(self,filters={},order_by=None):
+        """
+        Given the filters and order_by value, this returns a row per group, see get_grouped_queryset, streamed like
+        QuerySetReport.get_rows.
+
+        :param filters:   A dictionary of field/value pairs that the report can be filtered on.
+        :param order_by:  The label by which this report should be ordered.
+
+        :return:  A tuple of a row iterator and metadata.
+        """
+        qs = self.get_queryset(filters, None)
+        if self.get_database():
+            qs = qs.using(self.get_database())
+        grouped = self.get_grouped_queryset(qs, order_by)
+        rows = CountingIterator(grouped.iterator())
+        return rows,(("total",LazyRowCount(rows, grouped)),) + tuple(self.get_aggregate_data(qs))
+
 class SQLReport(Report):
     """
     A subclass of Report, used with raw SQL.
@@ -224,16 +821,22 @@ class SQLReport(Report):
     row_sql=None # sql statement with named  parameters in python syntax (e.g. "%(age)s" )
     aggregate_sql=None # sql statement that brings in aggregates. pulls from column name and value for first row only
     query_params=[] # list of tuples, (name,label,datatype) where datatype is a mapping to a registerd filtercontrol
+    fetch_size=REPORT_ROW_BATCH_SIZE # rows fetched from the database cursor at a time
+    # if True, row_sql and aggregate_sql have (unquoted) placeholders instead, e.g. "WHERE age > %(age)s", and the
+    # filters are passed to the database as parameters, see get_statement
+    bind_params=False
+    live_view=False # if True, views page through row_sql directly (see SQLReportRowQuery) and never build the report
+    concurrent_aggregates=False # if True, get_rows runs the aggregate query at the same time, on another connection
 
     #TODO this should be _private.
     def get_connection(self):
         """
-        Gets the django database connection.
+        Gets the django database connection, of the database from get_database.
 
         :return:  The database connection.
         """
-        from django.db import connection
-        return connection
+        from django.db import connections, DEFAULT_DB_ALIAS
+        return connections[self.get_database() or DEFAULT_DB_ALIAS]
 
     #TODO this should be _private.
     def get_cursor(self):
@@ -244,16 +847,35 @@ class SQLReport(Report):
         """
         return self.get_connection().cursor()
 
+    def get_server_side_cursor(self):
+        """
+        Gets a named cursor on PostgreSQL, which keeps the result set on the server and only sends fetch_size rows
+        per fetch, instead of the whole result set on execute.
+
+        :return: A psycopg2 named cursor, or None on other backends.
+        """
+        connection = self.get_connection()
+        if connection.vendor != 'postgresql':
+            return None
+        connection.cursor() # opens the connection if needed
+        # WITH HOLD keeps the cursor open across the commits made while the rows are stored in batches
+        cursor = connection.connection.cursor(name='reportengine_%s' % uuid.uuid4().hex, withhold=True)
+        cursor.itersize = self.fetch_size
+        return cursor
+
     #TODO use string formatting instead of older python replacement
     def get_row_sql(self, filters, order_by):
         """
-        This applies filters directly to the SQL string, which should contain python keyed strings.
+        This applies filters directly to the SQL string, which should contain python keyed strings. With bind_params
+        the SQL is returned as is, see get_statement.
 
         :param filters:  A dictionary of filters to apply to this sql.
         :param order_by: This is ignored, but may be used by subclasses.
         :return:  The text-replaced SQL, or none if self.row_sql doesn't exist.
         """
         if self.row_sql:
+            if self.bind_params:
+                return self.row_sql
             return self.row_sql % filters
         return None
     
@@ -265,25 +887,174 @@ class SQLReport(Report):
         :return:  The text-replaced SQL or None if self.aggregate_sql doesn't exist.
         """
         if self.aggregate_sql:
+            if self.bind_params:
+                return self.aggregate_sql
             return self.aggregate_sql % filters
         return None
 
+    def get_param_datatypes(self):
+        """
+        Maps the filters of query_params to their datatypes, e.g. {"date__gte": "datetime", "date__lt": "datetime"}.
+
+        :return:  A dictionary of filter name -> datatype.
+        """
+        datatypes = {}
+        for q in self.query_params:
+            control = FilterControl.create_from_datatype(q[2],q[0],q[1])
+            if control:
+                for name in control.get_fields().keys():
+                    datatypes[name] = q[2]
+        return datatypes
+
+    def get_statement(self, sql, filters):
+        """
+        Gets what to execute for SQL from get_row_sql or get_aggregate_sql. With bind_params, the named placeholders
+        are compiled to positional ones, and the filters are converted to the types of their query_params datatypes.
+        Missing filters are bound as NULL. Quoting the values is left to the database driver (psycopg2 and MySQLdb
+        do it on the client), this doesn't make the database reuse statements or plans.
+
+        :param sql: The SQL, or None.
+        :param filters: A dictionary of filters.
+        :return:  A tuple (sql, params), params is None unless bind_params is set.
+        """
+        if not sql or not self.bind_params:
+            return sql, None
+        sql, names = compile_statement(sql)
+        datatypes = self.get_param_datatypes()
+        params = []
+        for name in names:
+            value = filters.get(name)
+            convert = PARAM_DATATYPE_CONVERTERS.get(datatypes.get(name))
+            if convert and isinstance(value, basestring):
+                value = convert(value)
+            params.append(value)
+        return sql, params
+
+    def execute(self, cursor, sql, params):
+        """
+        Executes a statement from get_statement on a cursor.
+        """
+        if params is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, params)
+
+    def get_order_by_sql(self, order_by):
+        """
+        Builds the ORDER BY clause for ordering the rows by a label. The column is referred to by its position, so
+        labels needn't match the column names of row_sql.
+
+        :param order_by: A label, prefixed with "-" for descending order.
+        :return:  The ORDER BY clause, or an empty string if order_by is not a label.
+        """
+        if not order_by or not self.labels:
+            return ''
+        label = order_by.lstrip('-')
+        if label not in self.labels:
+            return ''
+        return ' ORDER BY %d%s' % (list(self.labels).index(label) + 1, order_by.startswith('-') and ' DESC' or '')
+
+    def wrap_sql(self, sql, order_by=None, limit=None, offset=0):
+        """
+        Wraps row SQL in a subquery, to order it by a label and fetch a page of it.
+
+        :param sql: The row SQL.
+        :param order_by: A label, prefixed with "-" for descending order.
+        :param limit: The number of rows to fetch, or None for all of them.
+        :param offset: The number of rows to skip.
+        :return:  The SQL, unchanged if there is nothing to order or page by.
+        """
+        order_by_sql = self.get_order_by_sql(order_by)
+        if not order_by_sql and limit is None:
+            return sql
+        sql = 'SELECT * FROM (%s) report_rows%s' % (sql.strip().rstrip(';'), order_by_sql)
+        if limit is not None:
+            sql += ' LIMIT %d OFFSET %d' % (limit, offset)
+        return sql
+
     #TODO make this _private.
-    #TODO Instead of fetchall, use a generator.
     def get_row_data(self, filters, order_by):
         """
         Returns the cursor based on a filter dictionary.
 
         :param filters:  A dictionary of field->value filters to filter the report.
-        :param order_by:  The field by which this report should be ordered.  (Currently ignored by get_row_sql)
-        :return:  A list of all results (from fetchall)
+        :param order_by:  The label by which this report should be ordered, see get_order_by_sql.
+        :return:  An iterator over the results (see iter_cursor)
+        """
+        sql, params = self.get_statement(self.get_row_sql(filters, order_by), filters)
+        if not sql:
+            return []
+        cursor = self.get_server_side_cursor() or self.get_cursor()
+        self.execute(cursor, self.wrap_sql(sql, order_by), params)
+        return self.iter_cursor(cursor)
+
+    def get_page_data(self, filters, order_by, offset, limit):
+        """
+        Fetches a page of rows, with LIMIT/OFFSET on the row SQL.
+
+        :param filters:  A dictionary of field->value filters to filter the report.
+        :param order_by:  The label by which this report should be ordered, see get_order_by_sql.
+        :param offset: The number of rows to skip.
+        :param limit: The number of rows to fetch.
+        :return:  A list of rows.
         """
-        sql = self.get_row_sql(filters, order_by)
+        sql, params = self.get_statement(self.get_row_sql(filters, order_by), filters)
         if not sql:
             return []
         cursor = self.get_cursor()
-        cursor.execute(sql)
-        return cursor.fetchall()
+        try:
+            self.execute(cursor, self.wrap_sql(sql, order_by, limit, offset), params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def get_query_estimate(self, filters, order_by=None):
+        sql, params = self.get_statement(self.get_row_sql(filters, order_by), filters)
+        if not sql:
+            return None
+        return explain_query(self.get_connection(), sql, params)
+
+    def get_row_count(self, filters):
+        """
+        Counts the rows of the report with a COUNT over the row SQL.
+
+        :param filters:  A dictionary of field->value filters to filter the report.
+        :return:  The number of rows.
+        """
+        sql, params = self.get_statement(self.get_row_sql(filters, None), filters)
+        if not sql:
+            return 0
+        cursor = self.get_cursor()
+        try:
+            self.execute(cursor, 'SELECT COUNT(*) FROM (%s) report_rows' % sql.strip().rstrip(';'), params)
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    def iter_cursor(self, cursor):
+        """
+        Yields the rows of an executed cursor, fetching fetch_size rows at a time. The cursor is closed once the rows
+        are exhausted.
+
+        Backends that can't keep a read cursor open across commits (e.g. sqlite) get all rows fetched up
+        front, the same way the Django ORM handles them.
+
+        :param cursor: A cursor on which a query has been executed.
+        :return:  A generator of result rows.
+        """
+        try:
+            if not self.get_connection().features.can_use_chunked_reads:
+                for row in cursor.fetchall():
+                    yield row
+                return
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
     
     def get_aggregate_data(self, filters):
         """
@@ -292,11 +1063,11 @@ class SQLReport(Report):
         :param filters: A dictionary of paramters by which this report will be filtered.
         :return:  The aggregates for this report, based on the aggregate sql.
         """
-        sql = self.get_aggregate_sql(filters)
+        sql, params = self.get_statement(self.get_aggregate_sql(filters), filters)
         if not sql:
             return []
         cursor = self.get_cursor()
-        cursor.execute(sql)
+        self.execute(cursor, sql, params)
         result = cursor.fetchone()
         
         agg = list()
@@ -304,6 +1075,55 @@ class SQLReport(Report):
             agg.append((cursor.description[i][0],result[i]))
         return agg
     
+    def can_query_concurrently(self):
+        """
+        Queries run in other threads get connections of their own (Django's connections are per thread), which can't
+        see in-memory sqlite databases.
+
+        :return:  True if the aggregate query can run in a thread of its own.
+        """
+        connection = self.get_connection()
+        return not (connection.vendor == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:'))
+
+    def start_aggregate_data(self, filters):
+        """
+        Runs get_aggregate_data in a thread, on a connection of its own that is closed when done.
+
+        :param filters: A dictionary of paramters by which this report will be filtered.
+        :return:  A function that waits for the thread, and returns a tuple of the aggregates and the exc_info of the
+                  exception it raised, if any.
+        """
+        result = {'aggregates': [], 'error': None}
+        def run():
+            try:
+                result['aggregates'] = self.get_aggregate_data(filters)
+            except Exception:
+                result['error'] = sys.exc_info()
+            finally:
+                self.get_connection().close()
+        thread = threading.Thread(target=run, name='reportengine-aggregates')
+        thread.start()
+        def wait():
+            thread.join()
+            return result['aggregates'], result['error']
+        return wait
+
+    def iter_rows_then_wait(self, rows, wait):
+        """
+        Yields the rows, then waits for the aggregate thread (see start_aggregate_data), so it never outlives them.
+        On PostgreSQL the row query only really runs as its rows are fetched, so waiting any earlier would run the
+        two queries one after the other.
+
+        :param rows: An iterator over the results (see iter_cursor).
+        :param wait: The function returned by start_aggregate_data.
+        :return:  A generator of result rows.
+        """
+        try:
+            for row in rows:
+                yield row
+        finally:
+            wait()
+
     def get_filter_form(self, data):
         """
         Returns the filter form based on filter data.
@@ -319,22 +1139,67 @@ class SQLReport(Report):
         form.full_clean()
         return form
 
-    # CONSIDER not ideal in terms paging, would be better to fetch within a range..
-    # TODO Make this work with order_by
-    # TODO Use a generator instead of getting a big list of results.
     # TODO Make the return from this function match the implied contract from all of the other subclasses of Report.
     def get_rows(self,filters={},order_by=None):
         """
-        This returns all of the rows in the report, ignores order_by
+        This returns all of the rows in the report, ordered by the label order_by (if any). See SQLReportRowQuery
+        for fetching pages of them.
 
         :param filters: A dictionary of filters upon which to filter the report.
         :param order_by: The field by which the report should be ordered.
-        :return:  A tuple of rows and aggregate data (no meta data!)
+        :return:  A tuple of a row iterator and aggregate data (no meta data!)
         """
+        if self.concurrent_aggregates and self.can_query_concurrently():
+            # the rows are queried and fetched while the aggregate query runs, the aggregates are PendingAggregates
+            wait = self.start_aggregate_data(filters)
+            try:
+                rows = self.get_row_data(filters, order_by)
+            except Exception:
+                wait()
+                raise
+            return self.iter_rows_then_wait(rows, wait),PendingAggregates(wait)
         rows = self.get_row_data(filters, order_by)
         agg = self.get_aggregate_data(filters)
         return rows,agg
 
+class SQLReportRowQuery(object):
+    """
+    Row access to a live SQLReport, without storing its rows first. Counting runs a COUNT over the row SQL, and
+    slicing only fetches the rows in the slice with LIMIT/OFFSET, so it can be handed to a Django Paginator.
+    """
+    def __init__(self, report, filters, order_by=None):
+        self.report = report
+        self.filters = filters
+        self.order_by = order_by
+        self.row_count = None
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        if self.row_count is None:
+            self.row_count = self.report.get_row_count(self.filters)
+        return self.row_count
+
+    def __iter__(self):
+        return iter(self.report.get_row_data(self.filters, self.order_by))
+
+    def __getitem__(self, val):
+        if isinstance(val, slice):
+            if val.start is not None and val.start < 0 or val.stop is None or val.stop < 0:
+                start, stop, step = val.indices(self.count())
+            else:
+                start, stop, step = val.start or 0, val.stop, val.step or 1
+            if start >= stop:
+                return []
+            return list(self.report.get_page_data(self.filters, self.order_by, start, stop - start))[::step]
+        if val < 0:
+            val += self.count()
+        rows = self.report.get_page_data(self.filters, self.order_by, val, 1) if val >= 0 else []
+        if not rows:
+            raise IndexError(val)
+        return rows[0]
+
 class DateSQLReport(SQLReport):
     """
     A date based SQL report.  Implies that the row and aggregate SQL should contain date__gte and date__lt variables.
@@ -346,6 +1211,3 @@ class DateSQLReport(SQLReport):
         "date__gte":lambda: (datetime.datetime.today() -datetime.timedelta(days=30)).strftime("%Y-%m-%d"),
         "date__lt":lambda: (datetime.datetime.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d"),
     }
-
-# TODO build AnnotatedReport that deals with .annotate functions in ORM
-
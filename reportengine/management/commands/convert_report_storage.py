@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+class Command(BaseCommand):
+    help = 'Move the results of completed report requests to another result store'
+    option_list = BaseCommand.option_list + (
+        make_option('-s', '--storage',
+            dest='storage',
+            default=None,
+            help='Result store to move results to (rows, chunks or file, defaults to REPORT_ROW_STORAGE)'
+            ),
+        )
+    
+    def handle(self, *args, **kwargs):
+        from reportengine.models import ReportRequest
+        from reportengine.resultstores import RESULT_STORES
+        from reportengine.settings import REPORT_ROW_STORAGE
+        storage = kwargs['storage'] or REPORT_ROW_STORAGE
+        if storage not in RESULT_STORES:
+            raise CommandError('Unknown result store %r' % storage)
+        for report_request in ReportRequest.objects.completed().exclude(storage=storage).iterator():
+            report_request.convert_storage(storage)
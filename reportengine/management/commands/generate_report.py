@@ -2,6 +2,7 @@ import reportengine
 import sys
 from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
+from reportengine.base import resolve_aggregates
 from reportengine.outputformats import CSVOutputFormat, XMLOutputFormat
 from urlparse import parse_qsl
 
@@ -90,6 +91,9 @@ class Command(BaseCommand):
         mask = report.get_default_mask()
         mask.update(filters)
         rows, aggregates = report.get_rows(mask, order_by=kwargs['order_by'])
+        # the output formats write the aggregates before the rows, so lazy ones (e.g. the total of a QuerySetReport)
+        # are evaluated now
+        aggregates = resolve_aggregates(aggregates)
 
         ## Get our output format, setting a default if one wasn't set or isn't valid for this report
         outputformat = None
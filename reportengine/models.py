@@ -1,11 +1,39 @@
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
-from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.db.models import Q, F
+from django.utils.encoding import smart_str
 
+import base64
 import datetime
+import hashlib
+import json
+import sys
+import zlib
 import reportengine
+from urllib import urlencode
 
 from jsonfield import JSONField
-from settings import STALE_REPORT_SECONDS
+from settings import STALE_REPORT_SECONDS, INFLIGHT_REPORT_SECONDS, REPORT_ROW_STORAGE, REPORT_EXPORT_COMPRESSION
+from outputformats import COMPRESSORS, CompressedFile, compress_chunks
+from base import QueryCostExceeded, resolve_aggregates
+
+## Compressing chunks with zstd requires the zstandard library
+## https://github.com/indygreg/python-zstandard
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+## Codec name -> (compress, decompress) used for ReportRequestChunk data
+CHUNK_CODECS = {'zlib': (zlib.compress, zlib.decompress)}
+if ZSTD_AVAILABLE:
+    CHUNK_CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor().compress(data),
+                            lambda data: zstandard.ZstdDecompressor().decompress(data))
 
 class AbstractScheduledTask(models.Model):
     """
@@ -26,13 +54,45 @@ class AbstractScheduledTask(models.Model):
             return result.state
         return None
     
-    def schedule_task(self):
+    def schedule_task(self, queue=None):
+        """
+        Queues the task building this request.
+
+        :param queue: The celery queue to send the task to, or None for the task's default queue.
+        """
         func = self.get_task_function()
-        return func.delay(self.token)
+        if queue:
+            result = func.apply_async((self.token,), queue=queue)
+        else:
+            result = func.delay(self.token)
+        # update() rather than save(), an eager task may already have saved its results on another instance
+        type(self).objects.filter(pk=self.pk).update(task=result.id)
+        self.task = result.id
+        return result
     
     class Meta:
         abstract = True
 
+def get_params_fingerprint(namespace, slug, params):
+    """
+    Builds a fingerprint identifying a report and its parameters. Unlike the request token, this is the same for
+    every request of the same report with the same parameters.
+
+    :param namespace: The report namespace.
+    :param slug: The report slug.
+    :param params: A dictionary of report parameters. Blank values are ignored, as they are when building the report.
+    :return:  An md5 hex digest.
+    """
+    normalized = sorted((smart_str(k), smart_str(v)) for k, v in params.items() if v not in ('', None))
+    return hashlib.md5("|".join([smart_str(namespace), smart_str(slug), urlencode(normalized)])).hexdigest()
+
+def get_inflight_key(fingerprint):
+    """
+    :param fingerprint: A fingerprint, as returned by get_params_fingerprint.
+    :return:  The cache key under which the token of the in-flight build for this fingerprint is registered.
+    """
+    return 'reportengine-inflight-%s' % fingerprint
+
 class ReportRequestManager(models.Manager):
     """
     The manager for report requests.
@@ -52,6 +112,59 @@ class ReportRequestManager(models.Manager):
         cutoff = datetime.datetime.now() - datetime.timedelta(seconds=STALE_REPORT_SECONDS)
         return self.filter(completion_timestamp__lte=cutoff).filter(Q(viewed_on__lte=cutoff) | Q(viewed_on__isnull=True))
     
+    def cached(self, fingerprint, ttl):
+        """
+        Gets the most recent completed request with a matching fingerprint that finished within ttl seconds.
+        Requests old enough to be considered stale are never returned.
+
+        :param fingerprint: A fingerprint, as returned by get_params_fingerprint.
+        :param ttl: The maximum age of the request's results, in seconds.
+        :return:  A ReportRequest, or None if there is no usable one.
+        """
+        now = datetime.datetime.now()
+        cutoff = max(now - datetime.timedelta(seconds=ttl), now - datetime.timedelta(seconds=STALE_REPORT_SECONDS))
+        qs = self.completed().filter(fingerprint=fingerprint, completion_timestamp__gte=cutoff)
+        try:
+            return qs.order_by('-completion_timestamp')[0]
+        except IndexError:
+            return None
+    
+    def inflight(self, fingerprint):
+        """
+        Gets the request registered as currently building results for a fingerprint.
+
+        :param fingerprint: A fingerprint, as returned by get_params_fingerprint.
+        :return:  A ReportRequest, or None if no build is running or the registered one has failed.
+        """
+        token = cache.get(get_inflight_key(fingerprint))
+        if not token:
+            return None
+        try:
+            report_request = self.get(token=token, completion_timestamp__isnull=True)
+        except self.model.DoesNotExist:
+            return None
+        if report_request.task_status() in ('FAILURE',):
+            return None
+        return report_request
+    
+    def claim_inflight(self, report_request):
+        """
+        Registers a saved request as the in-flight build for its fingerprint, unless an equivalent build is already
+        running. Registration uses cache.add, so of several concurrent claims only one wins.
+
+        :param report_request: An uncompleted ReportRequest with a fingerprint.
+        :return:  report_request if it should be built, otherwise the request of the running build to wait on.
+        """
+        key = get_inflight_key(report_request.fingerprint)
+        if cache.add(key, report_request.token, INFLIGHT_REPORT_SECONDS):
+            return report_request
+        running = self.inflight(report_request.fingerprint)
+        if running is None or running.pk == report_request.pk:
+            # The registered build finished or failed in the meantime, take over
+            cache.set(key, report_request.token, INFLIGHT_REPORT_SECONDS)
+            return report_request
+        return running
+    
     def cleanup_stale_requests(self):
         """
         Deletes all stale requests.
@@ -71,6 +184,10 @@ class ReportRequest(AbstractScheduledTask):
     params = JSONField() #GET params
     viewed_on = models.DateTimeField(blank=True, null=True)
     aggregates = JSONField(datatype=list)
+    fingerprint = models.CharField(max_length=32, blank=True, db_index=True)
+    storage = models.CharField(max_length=10, default='rows') # result store holding the rows, see REPORT_ROW_STORAGE
+    row_count = models.PositiveIntegerField(blank=True, null=True) # set when the report is built
+    byte_size = models.BigIntegerField(blank=True, null=True) # bytes taken by the stored rows
     
     objects = ReportRequestManager()
 
@@ -104,26 +221,15 @@ class ReportRequest(AbstractScheduledTask):
         """
         return ('reports-view', [self.namespace, self.slug], {})
     
-    def build_report(self):
+    def get_filters(self, report):
         """
-        build_report does this:
-            fetch the report associated to this report request,
-            constructs the filter form, based on this report request's params,
-            get the report's default mask,
-            updates it with the filters (again from params),
-            gets the report's results, ordered by the 'order_by' value in params
-            this then saves every row in the report as a reportrequestrow object.
-            the aggregates and completion timestamp are stored on this request.
+        Builds the filters the report is run with: the report's default mask, updated with the filters of this
+        request's params that are valid (blank ones are dropped).
+
+        :param report: The report instance, see get_report.
+        :return:  A dictionary of filters.
         """
         kwargs = self.params
-
-        # THis is like 90% the same 
-        #reportengine.autodiscover() ## Populate the reportengine registry
-        try:
-            report = self.get_report()
-        except Exception, err:
-            raise err  
-        
         filter_form = report.get_filter_form(kwargs)
         if filter_form.fields:
             if filter_form.is_valid():
@@ -132,7 +238,7 @@ class ReportRequest(AbstractScheduledTask):
                 filters = {}
         else:
             if report.allow_unspecified_filters:
-                filters = kwargs
+                filters = dict(kwargs)
             else:
                 filters = {}
         
@@ -141,26 +247,163 @@ class ReportRequest(AbstractScheduledTask):
             if filters[k] == '':
                 del filters[k]
         
-        ## Update the mask and run the report!
         mask = report.get_default_mask()
         mask.update(filters)
-        rows, aggregates = report.get_rows(mask, order_by=kwargs.get('order_by',None))
+        return mask
+
+    def build_report(self):
+        """
+        build_report does this:
+            fetch the report associated to this report request,
+            constructs the filter form, based on this report request's params,
+            get the report's default mask,
+            updates it with the filters (again from params),
+            gets the report's results, ordered by the 'order_by' value in params
+            checks the estimated cost of the report query, see Report.check_query_cost,
+            this then saves every row in the report to the REPORT_ROW_STORAGE result store.
+            the aggregates, row count, byte size and completion timestamp are stored on this request.
+
+        Raises QueryCostExceeded if the report query is over the report's limits and its cost_guard_action is
+        "reject". With "timeout", the query runs under the report's statement_timeout instead.
+        """
+        kwargs = self.params
+
+        try:
+            # THis is like 90% the same 
+            #reportengine.autodiscover() ## Populate the reportengine registry
+            try:
+                report = self.get_report()
+            except Exception, err:
+                raise err  
         
-        ReportRequestRow.objects.filter(report_request=self).delete()
+            ## Update the mask and run the report!
+            filters = self.get_filters(report)
+            order_by = kwargs.get('order_by',None)
+            action, message = report.check_query_cost(filters, order_by)
+            if action == 'reject':
+                raise QueryCostExceeded(message)
+            timeout = report.statement_timeout if action == 'timeout' else None
         
-        for index, row in enumerate(rows):
-            report_row = ReportRequestRow(report_request=self, row_number=index)
-            report_row.data = row
-            report_row.save()
+            self.get_result_store().delete()
+            self.storage = REPORT_ROW_STORAGE
+            self.row_count = self.byte_size = None
+            store = self.get_result_store()
+            if timeout:
+                report.set_statement_timeout(timeout)
+            try:
+                rows, aggregates = report.get_rows(filters, order_by=order_by)
+                store.write(rows)
+            except Exception:
+                if timeout:
+                    error = sys.exc_info()
+                    try:
+                        # the failed statement may have aborted the transaction, e.g. on hitting the timeout
+                        report.set_statement_timeout(None, rollback=True)
+                    except Exception:
+                        # Python 2 has no exception chaining, keep the error of the report
+                        pass
+                    raise error[0], error[1], error[2]
+                raise
+            if timeout:
+                report.set_statement_timeout(None)
+            self.row_count = store.row_count
+            self.byte_size = store.byte_size
         
-        self.aggregates = aggregates
-        self.completion_timestamp = datetime.datetime.now()
-        self.save()
+            self.aggregates = resolve_aggregates(aggregates)
+            self.completion_timestamp = datetime.datetime.now()
+            self.save()
+        finally:
+            # on failure too, so the next request builds the report again instead of waiting on this one
+            self.release_inflight()
+    
+    def release_inflight(self):
+        """
+        Removes this request from the in-flight registry, if it is the registered build for its fingerprint.
+        """
+        key = get_inflight_key(self.fingerprint)
+        if self.fingerprint and cache.get(key) == self.token:
+            cache.delete(key)
+    
+    def get_result_store(self):
+        """
+        Gets the result store holding the rows of this request.
+
+        :return:  An instance of a reportengine.resultstores.ResultStore subclass, picked by self.storage.
+        """
+        from resultstores import get_result_store
+        return get_result_store(self.storage)(self)
+    
+    def get_typed_rows(self, report):
+        """
+        Gets the stored rows, with the values of typed columns decoded back to their types, e.g. decimals and dates.
+        This is what output formats should render.
+
+        :param report: The report instance, see get_report.
+        :return:  A reportengine.resultstores.TypedRowQuery.
+        """
+        from resultstores import TypedRowQuery
+        return TypedRowQuery(self.get_result_store().get_rows(), report.get_column_types())
+    
+    def convert_storage(self, storage):
+        """
+        Moves the results of this request to another result store, streaming them from the old one.
+
+        :param storage: The slug of the result store to move to, e.g. "chunks".
+        """
+        from resultstores import get_result_store
+        if storage == self.storage:
+            return
+        old_store = self.get_result_store()
+        new_store = get_result_store(storage)(self)
+        new_store.write(old_store.get_rows())
+        ReportRequest.objects.filter(pk=self.pk).update(storage=storage, row_count=new_store.row_count,
+                                                        byte_size=new_store.byte_size)
+        self.storage = storage
+        self.row_count = new_store.row_count
+        self.byte_size = new_store.byte_size
+        old_store.delete()
     
     def get_task_function(self):
         from tasks import async_report
         return async_report
 
+@receiver(post_delete, sender=ReportRequest)
+def delete_report_request_results(sender, instance, **kwargs):
+    """
+    Deletes results kept outside of the database (e.g. by FileResultStore) along with their request.
+    """
+    instance.get_result_store().delete()
+
+class ReportCacheStatsManager(models.Manager):
+    """
+    The manager for report cache statistics.
+    """
+    def record(self, namespace, slug, hit):
+        """
+        Counts a cache lookup for a report.
+
+        :param namespace: The report namespace.
+        :param slug: The report slug.
+        :param hit: True if a cached report request was reused, False if a new one had to be built.
+        """
+        field = hit and 'hits' or 'misses'
+        stats, created = self.get_or_create(namespace=namespace, slug=slug)
+        self.filter(pk=stats.pk).update(**{field: F(field) + 1})
+
+class ReportCacheStats(models.Model):
+    """
+    Hit and miss counters of the report request cache, per report. Only reports with a cache_ttl are counted.
+    """
+    namespace = models.CharField(max_length=255)
+    slug = models.CharField(max_length=255)
+    hits = models.PositiveIntegerField(default=0)
+    misses = models.PositiveIntegerField(default=0)
+
+    objects = ReportCacheStatsManager()
+
+    class Meta:
+        unique_together = (('namespace', 'slug'),)
+
 class ReportRequestRow(models.Model):
     """
     Report Request Row holds report result rows for each report request.
@@ -171,52 +414,209 @@ class ReportRequestRow(models.Model):
     row_number = models.PositiveIntegerField()
     data = JSONField(datatype=list)
 
+    class Meta:
+        # composite index used by ReportRowQuery to fetch pages by row_number range
+        unique_together = (('report_request', 'row_number'),)
+
+class ReportRequestChunk(models.Model):
+    """
+    Report Request Chunk holds a run of consecutive result rows of a report request in a single record.
+
+    The rows are stored as a JSON list, compressed with the codec named in "codec" and base64 encoded, as
+    binary fields aren't available before Django 1.6. end_row is exclusive.
+    """
+    report_request = models.ForeignKey(ReportRequest, related_name='chunks')
+    start_row = models.PositiveIntegerField()
+    end_row = models.PositiveIntegerField()
+    codec = models.CharField(max_length=10)
+    data = models.TextField()
+
+    def set_rows(self, rows, codec):
+        """
+        Packs rows into this chunk.
+
+        :param rows: A list of result rows.
+        :param codec: The name of a codec in CHUNK_CODECS.
+        """
+        if codec not in CHUNK_CODECS:
+            raise ImproperlyConfigured('Unknown or unavailable chunk codec %r.' % codec)
+        compress = CHUNK_CODECS[codec][0]
+        self.codec = codec
+        self.data = base64.b64encode(compress(json.dumps(rows, cls=DjangoJSONEncoder)))
+
+    def get_rows(self):
+        """
+        Unpacks the rows of this chunk.
+
+        :return:  A list of result rows, each a list.
+        """
+        if self.codec not in CHUNK_CODECS:
+            raise ImproperlyConfigured('Unknown or unavailable chunk codec %r.' % self.codec)
+        decompress = CHUNK_CODECS[self.codec][1]
+        return json.loads(decompress(base64.b64decode(self.data)))
+
+class ReportRequestExportManager(models.Manager):
+    def get_export(self, report_request, format, task=''):
+        """
+        Gets the export of a report request in a format, creating it if there is none yet. The exports prebuilt when
+        the report completes are asked for at the same time as the ones users export, (report_request, format) is
+        unique so both end up with the same one.
+
+        :param report_request: A ReportRequest.
+        :param format: An output format slug.
+        :param task: The id of the task that will build the export, recorded if the export is created.
+        :return:  A tuple of the ReportRequestExport and whether it was created.
+        """
+        export, created = self.get_or_create(report_request=report_request, format=format,
+                                             defaults={'token': report_request.token + format, 'task': task})
+        export.report_request = report_request
+        return export, created
+
+    def build_exports(self, report_request, formats, task=''):
+        """
+        Builds exports of a completed report request in several formats at once. The rows of all the streaming
+        formats are read in a single pass, see write_payloads; other formats are built one by one. Formats the
+        report doesn't offer are skipped, and exports that are complete already are left alone.
+
+        :param report_request: A completed ReportRequest.
+        :param formats: A list of output format slugs.
+        :param task: The id of the task building the exports. It is recorded on the exports created here, so their
+                     task_status shows if the task fails.
+        :return:  A list of the ReportRequestExports.
+        """
+        report = report_request.get_report()
+        output_formats = dict((of.slug, of) for of in report.output_formats)
+        exports = []
+        streaming = []
+        for format in formats:
+            if format not in output_formats:
+                continue
+            export, created = self.get_export(report_request, format, task)
+            exports.append(export)
+            if export.completion_timestamp:
+                continue
+            if output_formats[format].streaming:
+                streaming.append((export, output_formats[format]))
+            else:
+                export.build_report()
+        if streaming:
+            self.write_payloads(streaming, streaming[0][0].get_output_context(report))
+        return exports
+
+    def write_payloads(self, exports, context):
+        """
+        Writes and saves the payloads of several exports of the same report request. Every row is read (and
+        decoded) once, and handed to the writers of all the formats.
+
+        :param exports: A list of (ReportRequestExport, OutputFormat) tuples, with streaming output formats.
+        :param context: The output context, see ReportRequestExport.get_output_context.
+        """
+        from django.core.files.base import File
+        import tempfile
+
+        payloads = []
+        try:
+            for export, outputformat in exports:
+                # written straight to a temporary file, which the storage then copies in chunks
+                output = tempfile.TemporaryFile()
+                encoding = export.get_payload_encoding(outputformat)
+                stream = encoding and CompressedFile(output, encoding, outputformat.compression_levels[encoding]) \
+                                  or output
+                payloads.append((output, encoding, stream, outputformat.get_writer(context, stream)))
+            for row in context['rows']:
+                for output, encoding, stream, writer in payloads:
+                    writer.write_row(row)
+            for (export, outputformat), (output, encoding, stream, writer) in zip(exports, payloads):
+                writer.close()
+                if stream is not output:
+                    stream.flush()
+                payload = File(output)
+                # Django < 1.5 can't tell the size of an anonymous temporary file on its own
+                payload.size = output.tell()
+                output.seek(0)
+                export.payload.save(export.get_payload_filename(outputformat.get_filename(context), encoding),
+                                    payload, False)
+                export.completion_timestamp = datetime.datetime.now()
+                export.save()
+        finally:
+            for payload in payloads:
+                payload[0].close()
+
 class ReportRequestExport(AbstractScheduledTask):
     report_request = models.ForeignKey(ReportRequest, related_name='exports')
     format = models.CharField(max_length=10)
     #mimetype = models.CharField(max_length=50)
     #content_disposition = models.CharField(max_length=200)
     payload = models.FileField(upload_to='reportengine/exports/%Y/%m/%d')
+
+    objects = ReportRequestExportManager()
+
+    class Meta:
+        unique_together = (('report_request', 'format'),)
     
     def build_report(self):
         """
         Builds the export from a previously-run report.
         """
-        from views import ReportRowQuery
-        from urllib import urlencode
-        
         from django.test.client import RequestFactory
         from django.core.files.base import ContentFile
         
         report = self.report_request.get_report()
-        object_list = ReportRowQuery(self.report_request.rows.all())
-        
-        
-        kwargs = {'report': report,
-                  'title':report.verbose_name,
-                  'rows':object_list,
-                  'filter_form':report.get_filter_form(data=None),
-                  "aggregates":self.report_request.aggregates,
-                  "cl":None,
-                  'report_request':self.report_request,
-                  "urlparams":urlencode(self.report_request.params)}
-        
+        kwargs = self.get_output_context(report)
         
         outputformat = None
         for of in report.output_formats:
             if of.slug == self.format:
                 outputformat = of
         
+        if outputformat.streaming:
+            type(self).objects.write_payloads([(self, outputformat)], kwargs)
+            return
+        
+        encoding = self.get_payload_encoding(outputformat)
         response = outputformat.get_response(kwargs, RequestFactory().get('/'))
         #TODO this is a hack
         filename = response.get('Content-Disposition', '').rsplit('filename=',1)[-1]
         if not filename:
             filename = u'%s.%s' % (self.token, self.format)
-        self.payload.save(filename, ContentFile(response.content), False)
+        content = response.content
+        if encoding:
+            content = ''.join(compress_chunks([content], encoding, outputformat.compression_levels[encoding]))
+        self.payload.save(self.get_payload_filename(filename, encoding), ContentFile(content), False)
         
         self.completion_timestamp = datetime.datetime.now()
         self.save()
-    
+
+    def get_output_context(self, report):
+        """
+        :return:  The context output formats render the stored rows of the report request with.
+        """
+        return {'report': report,
+                'title':report.verbose_name,
+                'rows':self.report_request.get_typed_rows(report),
+                'filter_form':report.get_filter_form(data=None),
+                "aggregates":self.report_request.aggregates,
+                "cl":None,
+                'report_request':self.report_request,
+                "urlparams":urlencode(self.report_request.params)}
+
+    def get_payload_encoding(self, outputformat):
+        """
+        Payloads are stored compressed with REPORT_EXPORT_COMPRESSION, unless the format is compressed already.
+
+        :return:  A key of COMPRESSORS, or None.
+        """
+        return outputformat.compressible and REPORT_EXPORT_COMPRESSION or None
+
+    def get_payload_filename(self, filename, encoding):
+        """
+        :param encoding: The content encoding the payload is compressed with, or None.
+        :return:  The file name with the extension of the encoding, e.g. "report.csv.gz".
+        """
+        if not encoding:
+            return filename
+        return '%s.%s' % (filename, COMPRESSORS[encoding][0])
+
     def get_task_function(self):
         from tasks import async_report_export
         return async_report_export
@@ -2,10 +2,30 @@ from django.core.exceptions import ImproperlyConfigured
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
 from django.utils.encoding import smart_unicode
 import csv
+import datetime
+import decimal
+import shutil
+import sys
+import tempfile
+import zlib
 from cStringIO import StringIO
-from xml.etree import ElementTree as ET
+from xml.sax.saxutils import XMLGenerator
+from settings import REPORT_ROW_BATCH_SIZE
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5 streams iterators handed to a plain HttpResponse
+    StreamingHttpResponse = HttpResponse
+
+try:
+    from django.utils import timezone
+except ImportError:
+    # Django < 1.4 has no time zone support, all datetimes are naive
+    timezone = None
 
 ## Exporting to XLS requires the xlwt library
 ## http://www.python-excel.org/
@@ -15,15 +35,298 @@ try:
 except ImportError:
     XLS_AVAILABLE = False
 
+## JSON exports use simplejson (and its C speedups) when it is installed,
+## and fall back to the standard library json module
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+## Exporting to XLSX requires the XlsxWriter library
+## https://xlsxwriter.readthedocs.io/
+try:
+    import xlsxwriter
+    XLSX_AVAILABLE = True
+except ImportError:
+    XLSX_AVAILABLE = False
+
+## Exporting to Parquet and Arrow IPC requires the pyarrow library
+## https://arrow.apache.org/docs/python/
+try:
+    import pyarrow
+    import pyarrow.parquet
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+## Compressing exports with zstd requires the zstandard library
+## https://github.com/indygreg/python-zstandard
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+## Content encoding -> (file extension, function returning a compressor for a level) used to compress exports
+COMPRESSORS = {'gzip': ('gz', lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS))}
+if ZSTD_AVAILABLE:
+    COMPRESSORS['zstd'] = ('zst', lambda level: zstandard.ZstdCompressor(level=level).compressobj())
+
+def compress_chunks(chunks, encoding, level):
+    """
+    Compresses a stream of data.
+
+    :param chunks: An iterable of strings.
+    :param encoding: A key of COMPRESSORS, e.g. "gzip".
+    :param level: The compression level.
+    :return:  A generator of compressed strings.
+    """
+    compressor = COMPRESSORS[encoding][1](level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class CompressedFile(object):
+    """
+    A file-like object that compresses everything written to it into another file. flush() writes out the rest of
+    the compressed data, and has to be called once when done.
+    """
+    def __init__(self, fileobj, encoding, level):
+        self.fileobj = fileobj
+        self.compressor = COMPRESSORS[encoding][1](level)
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.write(self.compressor.flush())
+
+def get_accepted_encodings(request):
+    """
+    :return:  The set of content encodings the request's Accept-Encoding header allows.
+    """
+    accepted = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = part.strip().lower().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if params[0] and quality > 0:
+            accepted.add(params[0])
+    return accepted
+
+## Report column type (see Report.column_types) -> the python types of its values as they come from the report.
+## Converters only take their fast path for these, anything else (e.g. None, or the strings dates and decimals are
+## decoded to from stored results) gets the generic conversion of the format
+COLUMN_PYTHON_TYPES = {
+    'text': (unicode,),
+    'integer': (int, long),
+    'float': (float,),
+    'decimal': (decimal.Decimal,),
+    'boolean': (bool,),
+    'date': (datetime.date,),
+    'datetime': (datetime.datetime,),
+    'time': (datetime.time,),
+}
+
+def make_naive_local(value):
+    """
+    Converts an aware datetime (see USE_TZ) to naive local time in the current time zone, for formats that can't hold
+    a time zone, such as spreadsheets.
+
+    :param value: Any value.
+    :return:  value, or its naive local time if it is an aware datetime.
+    """
+    if timezone is not None and isinstance(value, datetime.datetime) and timezone.is_aware(value):
+        return timezone.make_naive(value, timezone.get_current_timezone())
+    return value
+
+def compile_converter(column_type, convert, fallback):
+    """
+    Builds the converter of a column.
+
+    :param column_type: A column type, or None if unknown.
+    :param convert: The conversion of values of the python types of column_type.
+    :param fallback: The conversion of any other value.
+    :return:  A function converting a cell value.
+    """
+    types = COLUMN_PYTHON_TYPES.get(column_type)
+    if not types:
+        return fallback
+    def converter(val):
+        if type(val) in types:
+            return convert(val)
+        return fallback(val)
+    return converter
+
+class ChunkBuffer(object):
+    """
+    A file-like object that collects everything written to it until it is taken out with take().
+    """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+    def take(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        return data
+
+class OutputWriter(object):
+    """
+    Writes a report to a file-like object one row at a time. Whatever comes before the rows (e.g. aggregates and
+    labels) is written when the writer is created, and whatever comes after them by close().
+    """
+    converters = None
+
+    def __init__(self, output_format, context, output):
+        self.output_format = output_format
+        self.context = context
+        self.output = output
+
+    def compile_converter(self, column_type):
+        """
+        :param column_type: A column type (see Report.column_types), or None if unknown.
+        :return:  The converter of a column, see OutputFormat.get_converter.
+        """
+        return self.output_format.get_converter(column_type)
+
+    def get_converters(self, columns):
+        """
+        Gets the converters of the columns, compiled once per export from the report's column types.
+
+        :param columns: The number of cells in the row, columns without labels get converters for unknown types.
+        :return:  A list of converters.
+        """
+        if self.converters is None:
+            self.converters = [self.compile_converter(column_type)
+                                for column_type in self.context["report"].get_column_types()]
+        if columns > len(self.converters):
+            self.converters += [self.compile_converter(None) for i in range(columns - len(self.converters))]
+        return self.converters
+
+    def convert_row(self, row):
+        return [convert(val) for convert, val in zip(self.get_converters(len(row)), row)]
+
+    def write_row(self, row):
+        raise NotImplementedError("Use a subclass of OutputWriter.")
+
+    def close(self):
+        pass
+
 class OutputFormat(object):
     verbose_name="Abstract Output Format"
     slug="output"
     no_paging=False
+    streaming=False # True if get_writer is implemented, and the output can be produced row by row
+    content_type="application/octet-stream"
+    compressible=True # False for formats that are compressed already, e.g. zip based ones
+    compression_levels={'gzip': 6, 'zstd': 3} # per content encoding, used for responses and stored exports
 
     def generate_output(self, context, output):
         ## output is expected to be a file-like object, be it Django Response,
         ## StringIO, file, or sys.stdout. Anything sith a .write method should do.
-        raise NotImplemented("Use a subclass of OutputFormat.")
+        if not self.streaming:
+            raise NotImplementedError("Use a subclass of OutputFormat.")
+        writer = self.get_writer(context, output)
+        for row in context["rows"]:
+            writer.write_row(row)
+        writer.close()
+        return output
+
+    def get_converter(self, column_type):
+        """
+        Compiles the conversion of the cells of a column for this format. Converters are compiled once per export,
+        instead of checking the type of every cell.
+
+        :param column_type: A column type (see Report.column_types), or None if unknown.
+        :return:  A function converting a cell value.
+        """
+        return lambda val: val
+
+    def get_writer(self, context, output):
+        """
+        :param context: should be a dictionary with keys 'aggregates' and 'rows' and 'report'
+        :param output: a file-like object the writer writes to
+        :return:  An OutputWriter
+        """
+        raise NotImplementedError("Use a subclass of OutputFormat.")
+
+    def iter_output(self, context, chunk_rows=REPORT_ROW_BATCH_SIZE):
+        """
+        Generates the output in chunks of encoded data, chunk_rows rows at a time, so it can be streamed without
+        being held in memory.
+
+        :param context: should be a dictionary with keys 'aggregates' and 'rows' and 'report'
+        :param chunk_rows: the number of rows written per chunk
+        :return:  A generator of strings
+        """
+        buf = ChunkBuffer()
+        writer = self.get_writer(context, buf)
+        for index, row in enumerate(context["rows"]):
+            writer.write_row(row)
+            if (index + 1) % chunk_rows == 0:
+                data = buf.take()
+                if data:
+                    yield data
+        writer.close()
+        data = buf.take()
+        if data:
+            yield data
+
+    def get_filename(self, context):
+        """
+        :return: The file name used for downloads and export payloads of this format.
+        """
+        return '%s.%s' % (context['report'].slug, self.slug)
+
+    def get_content_encoding(self, request):
+        """
+        Negotiates the compression of a response from the request's Accept-Encoding header.
+
+        :return:  A key of COMPRESSORS, or None to send the output uncompressed.
+        """
+        if not self.compressible or request is None:
+            return None
+        accepted = get_accepted_encodings(request)
+        for encoding in ('zstd', 'gzip'):
+            if encoding in COMPRESSORS and encoding in accepted:
+                return encoding
+        return None
+
+    def iter_compressed_output(self, context, encoding):
+        """
+        :param encoding: A key of COMPRESSORS, or None for no compression.
+        :return:  A generator of the output, compressed with the level in compression_levels.
+        """
+        chunks = self.iter_output(context)
+        if encoding:
+            chunks = compress_chunks(chunks, encoding, self.compression_levels[encoding])
+        return chunks
+
+    def get_streaming_response(self, context, request):
+        """
+        A download of iter_output, compressed if the client accepts it.
+        """
+        encoding = self.get_content_encoding(request)
+        resp = StreamingHttpResponse(self.iter_compressed_output(context, encoding), content_type=self.content_type)
+        if encoding:
+            resp['Content-Encoding'] = encoding
+        if self.compressible:
+            patch_vary_headers(resp, ('Accept-Encoding',))
+        resp['Content-Disposition'] = 'attachment; filename=%s' % self.get_filename(context)
+        return resp
 
     def get_response(self,context,request):
         raise NotImplemented("Use a subclass of OutputFormat.")
@@ -40,10 +343,14 @@ class AdminOutputFormat(OutputFormat):
         return render_to_response('reportengine/report.html', context,
                               context_instance=RequestContext(request))
 
+def csv_cell(val):
+    return smart_unicode(val).encode('utf8')
+
 class CSVOutputFormat(OutputFormat):
     verbose_name="CSV (comma separated value)"
     slug="csv"
     no_paging=True
+    content_type="text/csv"
 
     # CONSIDER perhaps I could use **kwargs, but it is nice to see quickly what is available..
     def __init__(self,quotechar='"',quoting=csv.QUOTE_MINIMAL,delimiter=',',lineterminator='\n'):
@@ -52,31 +359,107 @@ class CSVOutputFormat(OutputFormat):
         self.delimiter=delimiter
         self.lineterminator=lineterminator
 
-    def generate_output(self, context, output):
-        """
-        :param context: should be a dictionary with keys 'aggregates' and 'rows' and 'report'
-        :param output: should be a file-like object to which output can be written?
-        :return: modified output object
-        """
-        w=csv.writer(output,
-                    delimiter=self.delimiter,
-                    quotechar=self.quotechar,
-                    quoting=self.quoting,
-                    lineterminator=self.lineterminator)
+    streaming=True
+
+    def get_writer(self, context, output):
+        return CSVWriter(self, context, output)
+
+    def get_converter(self, column_type):
+        if column_type == 'text':
+            return compile_converter(column_type, lambda val: val.encode('utf8'), csv_cell)
+        return compile_converter(column_type, str, csv_cell)
+
+    def get_response(self,context,request):
+        return self.get_streaming_response(context, request)
+
+class CSVWriter(OutputWriter):
+    def __init__(self, output_format, context, output):
+        super(CSVWriter, self).__init__(output_format, context, output)
+        self.writer=csv.writer(output,
+                    delimiter=output_format.delimiter,
+                    quotechar=output_format.quotechar,
+                    quoting=output_format.quoting,
+                    lineterminator=output_format.lineterminator)
         for a in context["aggregates"]:
-            w.writerow([smart_unicode(x).encode('utf8') for x in a])
-        w.writerow( context["report"].labels)
-        for r in context["rows"]:
-            w.writerow([smart_unicode(x).encode('utf8') for x in r])
-        return output
+            self.writer.writerow([smart_unicode(x).encode('utf8') for x in a])
+        self.writer.writerow( context["report"].labels)
+
+    def write_row(self, row):
+        self.writer.writerow(self.convert_row(row))
+
+
+def json_default(value):
+    """
+    Encodes values the JSON encoder doesn't know about: dates and times as ISO-8601 strings, decimals as numbers and
+    anything else as text.
+    """
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return smart_unicode(value)
+
+class JSONOutputFormat(OutputFormat):
+    """
+    A JSON document: {"labels": [...], "aggregates": [[name, value], ...], "rows": [[...], ...]}, one row per line.
+    Values keep their types, numbers stay numbers and dates and times become ISO-8601 strings.
+    """
+    verbose_name="JSON"
+    slug="json"
+    no_paging=True
+    streaming=True
+    content_type="application/json"
+
+    def get_encoder(self):
+        return json.JSONEncoder(default=json_default, separators=(',', ':'))
+
+    def get_writer(self, context, output):
+        return JSONWriter(self, context, output)
 
     def get_response(self,context,request):
-        resp = HttpResponse(mimetype='text/csv')
-        # CONSIDER maybe a "get_filename" from the report?
-        resp['Content-Disposition'] = 'attachment; filename=%s.csv'%context['report'].slug
-        self.generate_output(context, resp)
-        return resp
+        return self.get_streaming_response(context, request)
+
+class JSONWriter(OutputWriter):
+    def __init__(self, output_format, context, output):
+        super(JSONWriter, self).__init__(output_format, context, output)
+        self.encode = output_format.get_encoder().encode
+        self.first = True
+        output.write('{"labels":%s,"aggregates":%s,"rows":[' % (self.encode(list(context["report"].labels)),
+                                                                self.encode([list(a) for a in context["aggregates"]])))
+
+    def write_row(self, row):
+        self.output.write((self.first and '\n' or ',\n') + self.encode(row))
+        self.first = False
 
+    def close(self):
+        self.output.write('\n]}\n')
+
+class NDJSONOutputFormat(JSONOutputFormat):
+    """
+    Newline delimited JSON: a first line {"labels": [...], "aggregates": [[name, value], ...]}, followed by one line
+    per row holding the row as an array.
+    """
+    verbose_name="NDJSON (newline delimited JSON)"
+    slug="ndjson"
+    content_type="application/x-ndjson"
+
+    def get_writer(self, context, output):
+        return NDJSONWriter(self, context, output)
+
+class NDJSONWriter(OutputWriter):
+    def __init__(self, output_format, context, output):
+        super(NDJSONWriter, self).__init__(output_format, context, output)
+        self.encode = output_format.get_encoder().encode
+        output.write('{"labels":%s,"aggregates":%s}\n' % (self.encode(list(context["report"].labels)),
+                                                          self.encode([list(a) for a in context["aggregates"]])))
+
+    def write_row(self, row):
+        self.output.write(self.encode(row) + '\n')
+
+def xls_cell(val):
+    if isinstance(val, basestring):
+        return smart_unicode(val).encode('utf8')
+    return val
 
 class XLSOutputFormat(OutputFormat):
     no_paging = True
@@ -86,22 +469,51 @@ class XLSOutputFormat(OutputFormat):
     def generate_output(self, context, output):
         if not XLS_AVAILABLE:
             raise ImproperlyConfigured('Missing module xlwt.')
-        ## Put all our data into a big list
+        ## Put the aggregates and labels into a list
         rows = []
         rows.extend(context['aggregates'])
         rows.append(context['report'].labels)
-        rows.extend(context['rows'])
 
         ## Create the spreadsheet from our data
         workbook = xlwt.Workbook(encoding='utf8')
         worksheet = workbook.add_sheet('report')
         for row_index, row in enumerate(rows):
             for col_index, val in enumerate(row):
-                if isinstance(val, basestring):
-                    val = smart_unicode(val).encode('utf8')
-                worksheet.write(row_index, col_index, val)
+                worksheet.write(row_index, col_index, xls_cell(val))
+        converters = [self.get_converter(column_type) for column_type in context['report'].get_column_types()]
+        for row_index, row in enumerate(context['rows'], len(rows)):
+            if len(row) > len(converters):
+                converters += [self.get_converter(None) for i in range(len(row) - len(converters))]
+            xls_row = worksheet.row(row_index)
+            for col_index, (write, val) in enumerate(zip(converters, row)):
+                write(xls_row, col_index, val)
         workbook.save(output)
 
+    def get_converter(self, column_type):
+        """
+        :return:  A function (xlwt row, col_index, val) writing a cell of a column of column_type. Typed values skip
+                  the type checks of Row.write.
+        """
+        write_cell = lambda xls_row, col_index, val: xls_row.write(col_index, xls_cell(val))
+        setter = {'text': 'set_cell_text',
+                  'integer': 'set_cell_number',
+                  'float': 'set_cell_number',
+                  'decimal': 'set_cell_number',
+                  'boolean': 'set_cell_boolean',
+                  'date': 'set_cell_date',
+                  'datetime': 'set_cell_date'}.get(column_type)
+        if setter is None:
+            return write_cell
+        set_cell = getattr(xlwt.Row, setter)
+        types = COLUMN_PYTHON_TYPES[column_type]
+        def write_typed_cell(xls_row, col_index, val):
+            # empty strings are blank cells, which Row.write takes care of
+            if type(val) in types and val != u'':
+                set_cell(xls_row, col_index, val)
+            else:
+                write_cell(xls_row, col_index, val)
+        return write_typed_cell
+
     def get_response(self, context, request):
         resp = HttpResponse(mimetype='application/vnd.ms-excel')
         resp['Content-Disposition'] = 'attachment; filename=%s.xls' % context['report'].slug
@@ -109,36 +521,340 @@ class XLSOutputFormat(OutputFormat):
         return resp
 
 
+class FileOutputFormat(OutputFormat):
+    """
+    Base class of formats whose files are only complete once closed (e.g. they end with an index), so their writers
+    write to a temporary file (see TempFileWriter), which is streamed out afterwards.
+    """
+    no_paging = True
+    streaming = True
+    read_size = 64 * 1024
+
+    def iter_output(self, context, chunk_rows=REPORT_ROW_BATCH_SIZE):
+        writer = self.get_writer(context, None)
+        try:
+            for row in context["rows"]:
+                writer.write_row(row)
+            writer.close()
+            for data in iter(lambda: writer.file.read(self.read_size), ''):
+                yield data
+        finally:
+            writer.file.close()
+
+    def get_response(self, context, request):
+        return self.get_streaming_response(context, request)
+
+class TempFileWriter(OutputWriter):
+    """
+    Writes to a temporary file, self.file, which close() copies to the output. With output None, the temporary
+    file is left open (and rewound) instead.
+    """
+    def __init__(self, output_format, context, output):
+        super(TempFileWriter, self).__init__(output_format, context, output)
+        self.file = tempfile.TemporaryFile()
+
+    def close(self):
+        self.file.seek(0)
+        if self.output is not None:
+            shutil.copyfileobj(self.file, self.output)
+            self.file.close()
+
+class XLSXOutputFormat(FileOutputFormat):
+    """
+    Office Open XML spreadsheets, written with XlsxWriter in constant memory mode: every row is flushed to disk as soon
+    as the next one is written. Rows past max_sheet_rows continue on a new sheet, which repeats the labels.
+    """
+    slug = 'xlsx'
+    verbose_name = 'XLSX (Microsoft Excel 2007+)'
+    content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    compressible = False
+    max_sheet_rows = 1048576
+    datetime_format = 'yyyy-mm-dd hh:mm:ss'
+    date_format = 'yyyy-mm-dd'
+
+    def get_writer(self, context, output):
+        if not XLSX_AVAILABLE:
+            raise ImproperlyConfigured('Missing module xlsxwriter.')
+        return XLSXWriter(self, context, output)
+
+class XLSXWriter(TempFileWriter):
+    def __init__(self, output_format, context, output):
+        super(XLSXWriter, self).__init__(output_format, context, output)
+        self.workbook = xlsxwriter.Workbook(self.file, {'constant_memory': True})
+        self.datetime_format = self.workbook.add_format({'num_format': output_format.datetime_format})
+        self.date_format = self.workbook.add_format({'num_format': output_format.date_format})
+        self.worksheet = None
+        self.add_sheet()
+        # aggregates and then labels, like the other formats. Later sheets only start with the labels
+        for a in context['aggregates']:
+            self.write_cells(a)
+        self.write_cells(context['report'].labels)
+
+    def add_sheet(self):
+        sheets = len(self.workbook.worksheets())
+        self.worksheet = self.workbook.add_worksheet(sheets and 'report %s' % (sheets + 1) or 'report')
+        self.row_index = 0
+        self.converters = None
+
+    def write_cells(self, row):
+        for col_index, val in enumerate(row):
+            self.write_cell(self.row_index, col_index, val)
+        self.row_index += 1
+
+    def write_cell(self, row_index, col_index, val):
+        if val is None:
+            return
+        if isinstance(val, basestring):
+            # never write() strings, it would turn values starting with "=" into formulas
+            self.worksheet.write_string(row_index, col_index, smart_unicode(val))
+        elif isinstance(val, bool):
+            self.worksheet.write_boolean(row_index, col_index, val)
+        elif isinstance(val, (int, long, float, decimal.Decimal)):
+            self.worksheet.write_number(row_index, col_index, float(val))
+        elif isinstance(val, datetime.datetime):
+            # Excel has no time zones
+            self.worksheet.write_datetime(row_index, col_index, make_naive_local(val), self.datetime_format)
+        elif isinstance(val, datetime.date):
+            self.worksheet.write_datetime(row_index, col_index, val, self.date_format)
+        else:
+            self.worksheet.write_string(row_index, col_index, smart_unicode(val))
+
+    def compile_converter(self, column_type):
+        """
+        :return:  A function (row_index, col_index, val) writing a cell of a column of column_type.
+        """
+        # bound to the current worksheet, add_sheet() has them compiled again
+        worksheet = self.worksheet
+        if column_type == 'text':
+            write = worksheet.write_string
+        elif column_type in ('integer', 'float'):
+            write = worksheet.write_number
+        elif column_type == 'decimal':
+            write = lambda row_index, col_index, val: worksheet.write_number(row_index, col_index, float(val))
+        elif column_type == 'boolean':
+            write = worksheet.write_boolean
+        elif column_type == 'datetime':
+            write = lambda row_index, col_index, val: worksheet.write_datetime(row_index, col_index,
+                                                                               make_naive_local(val),
+                                                                               self.datetime_format)
+        elif column_type == 'date':
+            write = lambda row_index, col_index, val: worksheet.write_datetime(row_index, col_index, val,
+                                                                               self.date_format)
+        else:
+            return self.write_cell
+        types = COLUMN_PYTHON_TYPES[column_type]
+        write_cell = self.write_cell
+        def write_typed_cell(row_index, col_index, val):
+            if type(val) in types:
+                write(row_index, col_index, val)
+            else:
+                write_cell(row_index, col_index, val)
+        return write_typed_cell
+
+    def write_row(self, row):
+        if self.row_index >= self.output_format.max_sheet_rows:
+            self.add_sheet()
+            self.write_cells(self.context['report'].labels)
+        row_index = self.row_index
+        for col_index, (write, val) in enumerate(zip(self.get_converters(len(row)), row)):
+            write(row_index, col_index, val)
+        self.row_index += 1
+
+    def close(self):
+        self.workbook.close()
+        super(XLSXWriter, self).close()
+
+class ParquetOutputFormat(FileOutputFormat):
+    """
+    Apache Parquet files, for loading into pandas and other columnar tools. Rows are buffered and written a row group
+    of row_group_size rows at a time. Column types are inferred from the first row group, see get_schema, and the
+    aggregates are kept as JSON in the "reportengine.aggregates" key of the schema metadata. A later value that
+    doesn't fit its column's type fails the export, see get_arrow_converter.
+    """
+    slug = 'parquet'
+    verbose_name = 'Parquet'
+    content_type = 'application/vnd.apache.parquet'
+    compressible = False # compressed per column already, see compression
+
+    def __init__(self, row_group_size=65536, compression='snappy'):
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+    def get_writer(self, context, output):
+        if not PARQUET_AVAILABLE:
+            raise ImproperlyConfigured('Missing module pyarrow.')
+        return ArrowWriter(self, context, output)
+
+    def get_column_type(self, values, column_type=None):
+        """
+        :param values: The values of a column in the first row group.
+        :param column_type: The report column type (see Report.column_types), used if all the values are None, and to
+                            keep whole numbers of float and decimal columns as floats.
+        :return:  The pyarrow type of the column.
+        """
+        types = set(type(val) for val in values if val is not None)
+        if not types:
+            return {'integer': pyarrow.int64(),
+                    'float': pyarrow.float64(),
+                    'decimal': pyarrow.float64(),
+                    'boolean': pyarrow.bool_(),
+                    'date': pyarrow.date32(),
+                    'datetime': pyarrow.timestamp('us')}.get(column_type, pyarrow.string())
+        if types == set([bool]):
+            return pyarrow.bool_()
+        if types <= set([int, long]) and column_type not in ('float', 'decimal'):
+            return pyarrow.int64()
+        if types <= set([int, long, float, decimal.Decimal]):
+            return pyarrow.float64()
+        if types == set([datetime.datetime]):
+            return pyarrow.timestamp('us')
+        if types == set([datetime.date]):
+            return pyarrow.date32()
+        return pyarrow.string()
+
+    def get_schema(self, context, rows):
+        """
+        :param context: should be a dictionary with keys 'aggregates' and 'rows' and 'report'
+        :param rows: The rows of the first row group.
+        :return:  A pyarrow schema with a column per label.
+        """
+        labels = context["report"].labels
+        columns = zip(*rows) or [() for label in labels]
+        fields = [pyarrow.field(smart_unicode(label), self.get_column_type(values, column_type))
+                    for label, values, column_type in zip(labels, columns, context["report"].get_column_types())]
+        aggregates = json.dumps([list(a) for a in context["aggregates"]], default=json_default)
+        return pyarrow.schema(fields, metadata={'reportengine.aggregates': aggregates})
+
+    def get_arrow_converter(self, column_type, label=None):
+        """
+        :param column_type: The pyarrow type of the column.
+        :param label: The label of the column, for error messages.
+        :return:  A function that converts a value to column_type, for values that don't match the first row group.
+                  Numbers are never truncated: it raises ValueError for values that don't fit numeric columns.
+        """
+        if column_type == pyarrow.int64():
+            types, cast = (int, long), lambda val: val
+        elif column_type == pyarrow.float64():
+            types, cast = (int, long, float, decimal.Decimal), float
+        elif column_type == pyarrow.string():
+            return lambda val: val if val is None else smart_unicode(val)
+        else:
+            return lambda val: val
+        def convert(val):
+            if val is None:
+                return val
+            if type(val) in types:
+                return cast(val)
+            raise ValueError('Column %s holds %r, which does not fit the type %s inferred from the first row group. '
+                             'Set its type in the column_types of the report.' % (label, val, column_type))
+        return convert
+
+    def open_file(self, output, schema):
+        return pyarrow.parquet.ParquetWriter(output, schema, compression=self.compression)
+
+    def write_arrays(self, writer, arrays, schema):
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+class ArrowOutputFormat(ParquetOutputFormat):
+    """
+    Arrow IPC files (Feather v2), one record batch per row_group_size rows.
+    """
+    slug = 'arrow'
+    verbose_name = 'Arrow IPC'
+    content_type = 'application/vnd.apache.arrow.file'
+    compressible = True
+
+    def __init__(self, row_group_size=65536):
+        self.row_group_size = row_group_size
+
+    def open_file(self, output, schema):
+        return pyarrow.RecordBatchFileWriter(output, schema)
+
+    def write_arrays(self, writer, arrays, schema):
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+
+class ArrowWriter(TempFileWriter):
+    def __init__(self, output_format, context, output):
+        super(ArrowWriter, self).__init__(output_format, context, output)
+        self.rows = []
+        self.schema = None
+        self.converters = None
+        self.writer = None
+
+    def write_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.output_format.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.writer is None:
+            self.schema = self.output_format.get_schema(self.context, self.rows)
+            self.converters = [self.output_format.get_arrow_converter(field.type, field.name) for field in self.schema]
+            self.writer = self.output_format.open_file(self.file, self.schema)
+        if not self.rows:
+            return
+        try:
+            arrays = [pyarrow.array([convert(val) for val in values], type=field.type)
+                        for convert, field, values in zip(self.converters, self.schema, zip(*self.rows))]
+            self.output_format.write_arrays(self.writer, arrays, self.schema)
+        except Exception:
+            error = sys.exc_info()
+            self.writer.close()
+            raise error[0], error[1], error[2]
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        super(ArrowWriter, self).close()
 
 class XMLOutputFormat(OutputFormat):
     verbose_name="XML"
     slug="xml"
     no_paging=True
+    content_type="text/xml"
+    streaming=True
 
     def __init__(self,root_tag="output",row_tag="entry",aggregate_tag="aggregate"):
         self.root_tag=root_tag
         self.row_tag=row_tag
         self.aggregate_tag=aggregate_tag
 
-    def generate_output(self, context, output):
-        root = ET.Element(self.root_tag) # CONSIDER maybe a nicer name or verbose name or something
-        for a in context["aggregates"]:
-            ae=ET.SubElement(root,self.aggregate_tag)
-            ae.set("name",a[0])
-            ae.text=smart_unicode(a[1])
-        rows=context["rows"]
-        labels=context["report"].labels
-        for r in rows:
-            e=ET.SubElement(root,self.row_tag)
-            for l in range(len(labels)):
-                e1=ET.SubElement(e,labels[l])
-                e1.text = smart_unicode(r[l])
-        tree=ET.ElementTree(root)
-        tree.write(output)
+    def get_writer(self, context, output):
+        return XMLWriter(self, context, output)
+
+    def get_converter(self, column_type):
+        if column_type == 'text':
+            return compile_converter(column_type, lambda val: val, smart_unicode)
+        return compile_converter(column_type, unicode, smart_unicode)
 
     def get_response(self,context,request):
-        resp = HttpResponse(mimetype='text/xml')
-        # CONSIDER maybe a "get_filename" from the report?
-        resp['Content-Disposition'] = 'attachment; filename=%s.xml'%context['report'].slug
-        self.generate_output(context, resp)
-        return resp
+        return self.get_streaming_response(context, request)
+
+class XMLWriter(OutputWriter):
+    """
+    Writes the XML document incrementally: the root open tag and aggregates first, every row as it comes, and the
+    closing root tag last. No element tree is ever built.
+    """
+    def __init__(self, output_format, context, output):
+        super(XMLWriter, self).__init__(output_format, context, output)
+        self.labels = context["report"].labels
+        self.xml = XMLGenerator(output, 'utf-8')
+        self.xml.startDocument()
+        self.xml.startElement(output_format.root_tag, {}) # CONSIDER maybe a nicer name or verbose name or something
+        for a in context["aggregates"]:
+            self.xml.startElement(output_format.aggregate_tag, {"name": smart_unicode(a[0])})
+            self.xml.characters(smart_unicode(a[1]))
+            self.xml.endElement(output_format.aggregate_tag)
+
+    def write_row(self, row):
+        self.xml.startElement(self.output_format.row_tag, {})
+        for label, val in zip(self.labels, self.convert_row(row)):
+            self.xml.startElement(label, {})
+            self.xml.characters(val)
+            self.xml.endElement(label)
+        self.xml.endElement(self.output_format.row_tag)
+
+    def close(self):
+        self.xml.endElement(self.output_format.root_tag)
+        self.xml.endDocument()
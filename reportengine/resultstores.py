@@ -0,0 +1,424 @@
+"""
+Result stores hold the rows of finished report requests. A store is picked per request (ReportRequest.storage, set
+from the REPORT_ROW_STORAGE setting when the report is built) and is used both to write the rows as they stream out of
+the report, and to read them back for viewing and exporting.
+
+Reading is done through row query objects, which can be counted, iterated over and sliced like a list, so they can be
+handed to a Django Paginator as well as to output formats.
+"""
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Max
+
+import decimal
+import json
+import mmap
+import os
+import struct
+
+try:
+    from django.utils.dateparse import parse_date, parse_datetime, parse_time
+except ImportError:
+    # Django < 1.4, whose DjangoJSONEncoder writes dates and times in formats the form fields read
+    from django import forms
+    parse_date = forms.DateField().to_python
+    parse_datetime = forms.DateTimeField().to_python
+    parse_time = forms.TimeField().to_python
+
+from models import ReportRequestRow, ReportRequestChunk
+from outputformats import make_naive_local
+from settings import REPORT_ROW_BATCH_SIZE, REPORT_CHUNK_CODEC, REPORT_RESULT_FILE_ROOT
+
+def get_slice_indices(val, count):
+    """
+    Resolves a slice to (start, stop, step), like slice.indices, without counting the rows unless the slice is
+    open ended or uses negative indices.
+
+    :param val: A slice.
+    :param count: A callable returning the number of rows.
+    :return:  A tuple of start, stop and step.
+    """
+    if val.start is not None and val.start < 0 or val.stop is None or val.stop < 0:
+        return val.indices(count())
+    return val.start or 0, val.stop, val.step or 1
+
+## column type -> decoding of the values DjangoJSONEncoder stores as strings
+STORED_VALUE_DECODERS = {
+    'integer': int,
+    'float': float,
+    'decimal': decimal.Decimal,
+    'date': parse_date,
+    # DjangoJSONEncoder keeps the offset of aware datetimes, output formats get them in local time like naive ones
+    'datetime': lambda value: make_naive_local(parse_datetime(value)),
+    'time': parse_time,
+}
+
+class TypedRowQuery(object):
+    """
+    Wraps a row query, decoding the values of typed columns (see Report.get_column_types) back from the strings the
+    result stores keep them as, e.g. decimals and dates, so output formats write them with their types. Strings that
+    don't decode are left as they are.
+    """
+    def __init__(self, rows, column_types):
+        self.rows = rows
+        self.decoders = [(index, STORED_VALUE_DECODERS[column_type]) for index, column_type in enumerate(column_types)
+                         if column_type in STORED_VALUE_DECODERS]
+
+    def wrap(self, row):
+        row = list(row)
+        for index, decode in self.decoders:
+            if index < len(row) and isinstance(row[index], basestring):
+                try:
+                    value = decode(row[index])
+                except (ValueError, TypeError, ArithmeticError, ValidationError):
+                    continue
+                if value is not None:
+                    row[index] = value
+        return row
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        return self.rows.count()
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.wrap(row)
+
+    def __getitem__(self, val):
+        if isinstance(val, slice):
+            return [self.wrap(row) for row in self.rows[val]]
+        return self.wrap(self.rows[val])
+
+class ReportRowQuery(object):
+    """
+    Row access to results stored as ReportRequestRows. Slicing uses row_number range lookups, which are served by the
+    (report_request, row_number) index, instead of OFFSET, so every page costs the same.
+
+    If row_count is given (see ReportRequest.row_count), the rows are never counted in the database.
+    """
+    def __init__(self, queryset, row_count=None):
+        self.queryset = queryset
+        self.row_count = row_count
+
+    def wrap(self, entry):
+        return entry.data
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        if self.row_count is None:
+            self.row_count = self.queryset.count()
+        return self.row_count
+
+    def __iter__(self):
+        for entry in self.queryset.order_by('row_number').iterator():
+            yield self.wrap(entry)
+
+    def __getitem__(self, val):
+        if isinstance(val, slice):
+            start, stop, step = get_slice_indices(val, self.count)
+            results = list()
+            if start >= stop:
+                return results
+            entries = self.queryset.filter(row_number__gte=start, row_number__lt=stop).order_by('row_number')
+            for entry in entries:
+                results.append(self.wrap(entry))
+            return results[::step]
+        else:
+            if val < 0:
+                val += self.count()
+            try:
+                return self.wrap(self.queryset.get(row_number=val))
+            except self.queryset.model.DoesNotExist:
+                raise IndexError(val)
+
+class ReportChunkQuery(object):
+    """
+    Row access to results stored as ReportRequestChunks. Slicing only fetches the chunks covering the slice.
+    """
+    def __init__(self, queryset, row_count=None):
+        self.queryset = queryset
+        self.row_count = row_count
+
+    def wrap(self, chunk):
+        return chunk.get_rows()
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        if self.row_count is None:
+            self.row_count = self.queryset.aggregate(Max('end_row'))['end_row__max'] or 0
+        return self.row_count
+
+    def __iter__(self):
+        for chunk in self.queryset.order_by('start_row').iterator():
+            for row in self.wrap(chunk):
+                yield row
+
+    def __getitem__(self, val):
+        if isinstance(val, slice):
+            start, stop, step = get_slice_indices(val, self.count)
+            results = list()
+            if start >= stop:
+                return results
+            for chunk in self.queryset.filter(start_row__lt=stop, end_row__gt=start).order_by('start_row'):
+                rows = self.wrap(chunk)
+                results.extend(rows[max(start - chunk.start_row, 0):stop - chunk.start_row])
+            return results[::step]
+        else:
+            if val < 0:
+                val += self.count()
+            try:
+                chunk = self.queryset.get(start_row__lte=val, end_row__gt=val)
+            except self.queryset.model.DoesNotExist:
+                raise IndexError(val)
+            return self.wrap(chunk)[val - chunk.start_row]
+
+class ReportFileQuery(object):
+    """
+    Row access to results written by FileResultStore. The index and data files are memory mapped, so reading a slice
+    only touches the bytes of the rows in it, and never the database.
+    """
+    def __init__(self, index_path, data_path):
+        self.index_path = index_path
+        self.data_path = data_path
+        self.index = None
+        self.data = None
+
+    def open(self):
+        if self.index is None:
+            with open(self.index_path, 'rb') as f:
+                self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # mmap refuses empty files, which is what a report without rows leaves behind
+            if os.path.getsize(self.data_path):
+                with open(self.data_path, 'rb') as f:
+                    self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ''
+
+    def close(self):
+        for m in (self.index, self.data):
+            if isinstance(m, mmap.mmap):
+                m.close()
+        self.index = self.data = None
+
+    def offset(self, row_number):
+        return struct.unpack_from('<Q', self.index, row_number * FileResultStore.offset_size)[0]
+
+    def wrap(self, line):
+        return json.loads(line)
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        self.open()
+        return len(self.index) // FileResultStore.offset_size - 1
+
+    def __iter__(self):
+        count = self.count()
+        for start in xrange(0, count, REPORT_ROW_BATCH_SIZE):
+            for row in self[start:start + REPORT_ROW_BATCH_SIZE]:
+                yield row
+
+    def __getitem__(self, val):
+        self.open()
+        if isinstance(val, slice):
+            start, stop, step = val.indices(self.count())
+            if start >= stop:
+                return list()
+            lines = self.data[self.offset(start):self.offset(stop)].split('\n')[:-1]
+            return [self.wrap(line) for line in lines[::step]]
+        else:
+            count = self.count()
+            if val < 0:
+                val += count
+            if not 0 <= val < count:
+                raise IndexError(val)
+            return self.wrap(self.data[self.offset(val):self.offset(val + 1)])
+
+class ResultStore(object):
+    """
+    Base class of result stores. Subclasses write a batch of rows in save_batch, and return a row query from get_rows.
+    After write, row_count and byte_size hold the number of rows and the number of bytes they were stored in.
+    """
+    slug = None
+
+    def __init__(self, report_request):
+        self.report_request = report_request
+        self.row_count = 0
+        self.byte_size = 0
+
+    def write(self, rows):
+        """
+        Writes result rows, REPORT_ROW_BATCH_SIZE at a time. Rows are consumed as a stream, only one batch is held
+        in memory.
+
+        :param rows: An iterable of result rows.
+        """
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= REPORT_ROW_BATCH_SIZE:
+                self.byte_size += self.save_batch(self.row_count, batch)
+                self.row_count += len(batch)
+                batch = []
+        if batch:
+            self.byte_size += self.save_batch(self.row_count, batch)
+            self.row_count += len(batch)
+        self.finish()
+
+    def save_batch(self, start, batch):
+        """
+        Writes a batch of consecutive rows.
+
+        :param start: The row number of the first row in the batch.
+        :param batch: A list of result rows.
+        :return:  The number of bytes the batch was stored in.
+        """
+        raise NotImplementedError("Use a subclass of ResultStore.")
+
+    def finish(self):
+        """
+        Called once all rows have been written.
+        """
+        pass
+
+    def get_rows(self):
+        """
+        :return:  A row query over the stored rows.
+        """
+        raise NotImplementedError("Use a subclass of ResultStore.")
+
+    def delete(self):
+        """
+        Deletes the stored rows.
+        """
+        raise NotImplementedError("Use a subclass of ResultStore.")
+
+class RowResultStore(ResultStore):
+    """
+    Stores every row as its own ReportRequestRow, one transaction per batch.
+    """
+    slug = 'rows'
+
+    def save_batch(self, start, batch):
+        data_field = ReportRequestRow._meta.get_field('data')
+        byte_size = 0
+        report_rows = []
+        for index, row in enumerate(batch):
+            report_row = ReportRequestRow(report_request=self.report_request, row_number=start + index)
+            report_row.data = row
+            report_rows.append(report_row)
+            byte_size += len(data_field.dumps(row))
+        with transaction.commit_on_success():
+            if hasattr(ReportRequestRow.objects, 'bulk_create'):
+                ReportRequestRow.objects.bulk_create(report_rows)
+            else:
+                # Django < 1.4 has no bulk_create, fall back to one INSERT per row
+                for report_row in report_rows:
+                    report_row.save()
+        return byte_size
+
+    def get_rows(self):
+        return ReportRowQuery(self.report_request.rows.all(), self.report_request.row_count)
+
+    def delete(self):
+        ReportRequestRow.objects.filter(report_request=self.report_request).delete()
+
+class ChunkResultStore(ResultStore):
+    """
+    Stores every batch of rows as one compressed ReportRequestChunk, see REPORT_CHUNK_CODEC.
+    """
+    slug = 'chunks'
+
+    def save_batch(self, start, batch):
+        chunk = ReportRequestChunk(report_request=self.report_request, start_row=start, end_row=start + len(batch))
+        chunk.set_rows(batch, REPORT_CHUNK_CODEC)
+        with transaction.commit_on_success():
+            chunk.save()
+        return len(chunk.data)
+
+    def get_rows(self):
+        return ReportChunkQuery(self.report_request.chunks.all(), self.report_request.row_count)
+
+    def delete(self):
+        ReportRequestChunk.objects.filter(report_request=self.report_request).delete()
+
+class FileResultStore(ResultStore):
+    """
+    Stores rows on local disk under REPORT_RESULT_FILE_ROOT, as a data file of JSON encoded rows, one per line, and an
+    index file of the byte offsets at which the rows start. The web and worker processes have to share that
+    directory.
+    """
+    slug = 'file'
+    offset_size = struct.calcsize('<Q')
+
+    def __init__(self, report_request):
+        super(FileResultStore, self).__init__(report_request)
+        self.index_file = None
+        self.data_file = None
+        self.position = 0
+
+    def get_path(self, extension):
+        return os.path.join(REPORT_RESULT_FILE_ROOT, '%s.%s' % (self.report_request.token, extension))
+
+    def save_batch(self, start, batch):
+        if self.data_file is None:
+            if not os.path.isdir(REPORT_RESULT_FILE_ROOT):
+                os.makedirs(REPORT_RESULT_FILE_ROOT)
+            # written under temporary names and renamed when complete, readers never see a partial result
+            self.index_file = open(self.get_path('idx.tmp'), 'wb')
+            self.data_file = open(self.get_path('dat.tmp'), 'wb')
+            self.position = 0
+        batch_start = self.position
+        offsets = []
+        lines = []
+        for row in batch:
+            line = json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+            offsets.append(self.position)
+            lines.append(line)
+            self.position += len(line)
+        self.index_file.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        self.data_file.write(''.join(lines))
+        return self.position - batch_start
+
+    def finish(self):
+        if self.data_file is None:
+            # no rows were written
+            self.save_batch(0, [])
+        self.index_file.write(struct.pack('<Q', self.position))
+        self.index_file.close()
+        self.data_file.close()
+        os.rename(self.get_path('idx.tmp'), self.get_path('idx'))
+        os.rename(self.get_path('dat.tmp'), self.get_path('dat'))
+        self.index_file = self.data_file = None
+
+    def get_rows(self):
+        return ReportFileQuery(self.get_path('idx'), self.get_path('dat'))
+
+    def delete(self):
+        for extension in ('idx', 'dat', 'idx.tmp', 'dat.tmp'):
+            try:
+                os.remove(self.get_path(extension))
+            except OSError:
+                pass
+
+RESULT_STORES = dict((store.slug, store) for store in (RowResultStore, ChunkResultStore, FileResultStore))
+
+def get_result_store(slug):
+    """
+    Fetches a result store class by slug.
+
+    :param slug: The slug of the result store, e.g. "rows".
+    :return:  A subclass of ResultStore.
+    """
+    try:
+        return RESULT_STORES[slug]
+    except KeyError:
+        raise ImproperlyConfigured('Unknown result store %r.' % slug)
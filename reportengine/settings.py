@@ -1,5 +1,32 @@
 from django.conf import settings
+import os
+import tempfile
 
 ASYNC_REPORTS = getattr(settings, "ASYNC_REPORTS", False)
 STALE_REPORT_SECONDS = getattr(settings, "STALE_REPORT_SECONDS", 6*60*60)
 MAX_ROWS_FOR_QUICK_EXPORT = getattr(settings, "MAX_ROWS_FOR_QUICK_EXPORT", 1000)
+REPORT_ROW_BATCH_SIZE = getattr(settings, "REPORT_ROW_BATCH_SIZE", 500)
+# How long a report request stays registered as the in-flight build for its params. Coalescing concurrent
+# requests across processes needs a shared cache backend (e.g. memcached).
+INFLIGHT_REPORT_SECONDS = getattr(settings, "INFLIGHT_REPORT_SECONDS", 60*60)
+# Storage of report results: "rows" (one ReportRequestRow per row), "chunks" (compressed ReportRequestChunks)
+# or "file" (memory mapped files in REPORT_RESULT_FILE_ROOT), see reportengine.resultstores
+REPORT_ROW_STORAGE = getattr(settings, "REPORT_ROW_STORAGE", "rows")
+# Compression of ReportRequestChunks: "zlib", or "zstd" if the zstandard module is installed
+REPORT_CHUNK_CODEC = getattr(settings, "REPORT_CHUNK_CODEC", "zlib")
+# Local directory for the "file" result store, must be shared by the web and worker processes
+REPORT_RESULT_FILE_ROOT = getattr(settings, "REPORT_RESULT_FILE_ROOT",
+                                  os.path.join(tempfile.gettempdir(), "reportengine", "results"))
+# Compression of stored export payloads: "gzip", "zstd" if the zstandard module is installed, or None
+REPORT_EXPORT_COMPRESSION = getattr(settings, "REPORT_EXPORT_COMPRESSION", "gzip")
+# Slugs of the output formats exported as soon as a report request is built asynchronously, e.g. ("csv", "xls").
+# Can be set per report with Report.prebuilt_export_formats
+REPORT_PREBUILT_EXPORT_FORMATS = getattr(settings, "REPORT_PREBUILT_EXPORT_FORMATS", ())
+# Alias of the database reports are run against (e.g. a read replica), unless a report sets its own with
+# Report.using. Report results are still written to the database of the reportengine models
+REPORT_DATABASE = getattr(settings, "REPORT_DATABASE", None)
+# Celery queue for building reports whose queries are estimated to exceed their limits, with
+# Report.cost_guard_action = "slow_queue". None keeps them on the default queue
+REPORT_SLOW_QUEUE = getattr(settings, "REPORT_SLOW_QUEUE", None)
+# Statement timeout in milliseconds for reports over their limits, with Report.cost_guard_action = "timeout"
+REPORT_STATEMENT_TIMEOUT = getattr(settings, "REPORT_STATEMENT_TIMEOUT", 5*60*1000)
@@ -14,6 +14,8 @@ def async_report(token):
     # THis is like 90% the same 
     reportengine.autodiscover() ## Populate the reportengine registry
     report_request.build_report()
+    if report_request.get_report().prebuilt_export_formats:
+        async_report_prebuild_exports.delay(token)
 
 @task()
 def async_report_export(token):
@@ -28,6 +30,20 @@ def async_report_export(token):
     report_request_export.build_report()
 
 
+@task()
+def async_report_prebuild_exports(token):
+    """
+    Builds the exports of a report request in all of its report's prebuilt_export_formats, in one pass over the rows.
+    """
+    try:
+        report_request = ReportRequest.objects.get(token=token)
+    except ReportRequest.DoesNotExist:
+        return
+    reportengine.autodiscover() ## Populate the reportengine registry
+    ReportRequestExport.objects.build_exports(report_request, report_request.get_report().prebuilt_export_formats,
+                                              async_report_prebuild_exports.request.id or '')
+
+
 @task()
 def cleanup_stale_reports():
     ReportRequest.objects.cleanup_stale_requests()
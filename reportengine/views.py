@@ -8,9 +8,12 @@ from django.http import HttpResponseRedirect, Http404
 from django.conf import settings
 from django.views.generic import ListView, View, TemplateView
 from django.views.decorators.cache import never_cache
+from django.forms.forms import NON_FIELD_ERRORS
 
 import reportengine
-from reportengine.models import ReportRequest, ReportRequestExport
+from reportengine.models import ReportRequest, ReportRequestExport, ReportCacheStats, get_params_fingerprint
+from reportengine.base import SQLReportRowQuery
+from reportengine.resultstores import ReportRowQuery
 from urllib import urlencode
 import datetime,calendar,hashlib
 
@@ -28,28 +31,6 @@ def report_list(request):
     return render_to_response('reportengine/list.html', {'reports': reports},
                               context_instance=RequestContext(request))
 
-class ReportRowQuery(object):
-    def __init__(self, queryset):
-        self.queryset = queryset
-    
-    def wrap(self, entry):
-        return entry.data
-    
-    def __len__(self):
-        return len(self.queryset)
-    
-    def count(self):
-        return self.queryset.count()
-    
-    def __getitem__(self, val):
-        if isinstance(val, slice):
-            results = list()
-            for entry in self.queryset[val]:
-                results.append(self.wrap(entry))
-            return results
-        else:
-            return self.wrap(self.queryset[val])
-
 class RequestReportMixin(object):
     asynchronous_report = ASYNC_REPORTS
     
@@ -71,6 +52,7 @@ creport requested
 
 class RequestReportView(TemplateView, RequestReportMixin):
     template_name = 'reportengine/request_report.html'
+    report_request_reused = False
     
     def report_params(self):
         '''
@@ -89,13 +71,33 @@ class RequestReportView(TemplateView, RequestReportMixin):
         report_params = self.report_params()
         namespace = self.kwargs.get('namespace', self.request.POST.get('namespace'))
         slug = self.kwargs.get('slug', self.request.POST.get('slug'))
+        fingerprint = get_params_fingerprint(namespace, slug, report_params)
+        cache_ttl = self.get_report_class().cache_ttl
+        if cache_ttl:
+            rr = ReportRequest.objects.cached(fingerprint, cache_ttl)
+            ReportCacheStats.objects.record(namespace, slug, hit=rr is not None)
+            if rr is not None:
+                self.report_request_reused = True
+                return rr
         token_params = [str(datetime.datetime.now()), namespace, slug, urlencode(report_params)]
         token = hashlib.md5("|".join(token_params)).hexdigest()
         rr = ReportRequest(token=token,
                            namespace=namespace,
                            slug=slug,
-                           params=report_params)
+                           params=report_params,
+                           fingerprint=fingerprint)
+        live_view = getattr(self.get_report_class(), 'live_view', False)
+        if live_view:
+            # there is nothing to build, so it is complete straight away (and cleaned up once stale, like the others)
+            rr.completion_timestamp = datetime.datetime.now()
         rr.save()
+        if self.asynchronous_report and not live_view:
+            # attach to an equivalent build that is already running instead of scheduling another one
+            running = ReportRequest.objects.claim_inflight(rr)
+            if running.pk != rr.pk:
+                rr.delete()
+                self.report_request_reused = True
+                return running
         return rr
     
     #CONSIDER inherit from a form view
@@ -121,7 +123,7 @@ class RequestReportView(TemplateView, RequestReportMixin):
     
     def get_context_data(self, **kwargs):
         context = TemplateView.get_context_data(self, **kwargs)
-        context['filter_form'] = self.get_form()
+        context['filter_form'] = self.form if hasattr(self, 'form') else self.get_form()
         context['report'] = self.get_report_class()()
         context['requested_reports'] = self.get_requested_reports()
         return context
@@ -129,8 +131,13 @@ class RequestReportView(TemplateView, RequestReportMixin):
     def create_and_redirect_to_report_request(self):
         self.report_request = self.create_report_request()
         self.report = self.report_request.get_report()
-        if self.asynchronous_report:
-            self.task = self.report_request.schedule_task()
+        if self.report_request_reused:
+            pass # a cached or already running build of the same report is used, there is nothing to schedule
+        elif getattr(self.report, 'live_view', False):
+            pass # the rows are fetched from the report as they are viewed, see ReportView
+        elif self.asynchronous_report:
+            queue = self.report.slow_queue if getattr(self, 'cost_guard_action', None) == 'slow_queue' else None
+            self.task = self.report_request.schedule_task(queue=queue)
         else:
             self.report_request.build_report()
             self.report_request = ReportRequest.objects.get(pk=self.report_request.pk)
@@ -139,13 +146,32 @@ class RequestReportView(TemplateView, RequestReportMixin):
     
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
-        if not context['filter_form'].fields and not context['requested_reports']:
+        if not context['filter_form'].fields and not context['requested_reports'] \
+                and self.check_query_cost(context['filter_form']):
             return self.create_and_redirect_to_report_request()
         return self.render_to_response(context)
     
+    def check_query_cost(self, form):
+        """
+        Runs the report's query cost guard (see Report.check_query_cost) against the submitted filters. A rejected
+        query is added to the filter form as a validation error.
+
+        :param form: The filter form.
+        :return:  False if the query was rejected.
+        """
+        report = self.get_report_class()()
+        if getattr(report, 'live_view', False):
+            return True # live views only ever query a page of rows
+        filters = ReportRequest(params=self.report_params()).get_filters(report)
+        self.cost_guard_action, message = report.check_query_cost(filters, self.report_params().get('order_by'))
+        if self.cost_guard_action == 'reject':
+            form.errors[NON_FIELD_ERRORS] = form.error_class([message])
+            return False
+        return True
+    
     def post(self, request, *args, **kwargs):
         self.form = self.get_form()
-        if self.form.is_valid(): #TODO filter controls need to be optional
+        if self.form.is_valid() and self.check_query_cost(self.form): #TODO filter controls need to be optional
             return self.create_and_redirect_to_report_request()
         else:
             context = self.get_context_data(**kwargs)
@@ -163,8 +189,24 @@ class ReportView(ListView, RequestReportMixin):
         self.report = self.report_request.get_report()
         ReportRequest.objects.filter(pk=self.report_request.pk).update(viewed_on=datetime.datetime.now())
     
+    def is_live_view(self):
+        return getattr(self.report, 'live_view', False)
+
+    def get_filters(self):
+        if not hasattr(self, 'filters'):
+            self.filters = self.report_request.get_filters(self.report)
+        return self.filters
+
     def get_queryset(self):
-        return ReportRowQuery(self.report_request.rows.all())
+        if self.is_live_view():
+            order_by = self.request.GET.get('order_by', self.report_request.params.get('order_by'))
+            return SQLReportRowQuery(self.report, self.get_filters(), order_by)
+        return self.report_request.get_typed_rows(self.report)
+
+    def get_aggregates(self):
+        if self.is_live_view():
+            return self.report.get_aggregate_data(self.get_filters())
+        return self.report_request.aggregates
     
     def get_filter_form(self):
         filter_form = self.report.get_filter_form(self.report_request.params)
@@ -210,7 +252,7 @@ class ReportView(ListView, RequestReportMixin):
                     'title':self.report.verbose_name,
                     'rows':self.object_list,
                     'filter_form':self.get_filter_form(),
-                    "aggregates":self.report_request.aggregates,
+                    "aggregates":self.get_aggregates(),
                     "cl":self.get_changelist(data),
                     'report_request':self.report_request,
                     "urlparams":urlencode(self.report_request.params)})
@@ -221,7 +263,7 @@ class ReportView(ListView, RequestReportMixin):
             self.get_report_request()
         except ReportRequest.DoesNotExist:
             raise Http404()
-        status = self.check_report_status()
+        status = self.is_live_view() and {'completed': True} or self.check_report_status()
         if 'error' in status: #there was an error, try recreating the report
             #CONSIDER add max retries
             return HttpResponseRedirect(self.report_request.get_report_url())
@@ -259,13 +301,11 @@ class ReportExportView(TemplateView, RequestReportMixin):
         ReportRequest.objects.filter(pk=self.report_request.pk).update(viewed_on=datetime.datetime.now())
     
     def get_report_export_request(self):
-        try:
-            self.report_export_request = self.report_request.exports.get(format=self.kwargs['output'])
-        except ReportRequestExport.DoesNotExist:
-            self.report_export_request = ReportRequestExport(report_request=self.report_request,
-                                                             format=self.kwargs['output'],
-                                                             token=(self.report_request.token + self.kwargs['output']),)
-            self.report_export_request.save()
+        self.report_export_request, created = ReportRequestExport.objects.get_export(self.report_request,
+                                                                                   self.kwargs['output'])
+        # an incomplete export without a task to report on, e.g. one left by build_exports failing outside of a
+        # task, is built again
+        if created or not (self.report_export_request.completion_timestamp or self.report_export_request.task):
             #TODO if the parent report is done and has under a certain number of rows, then no async is needed
             #however if opting the no-async route then it may not be necessary to create this object and upload the result to s3
             if self.asynchronous_report:
@@ -290,6 +330,9 @@ class ReportExportView(TemplateView, RequestReportMixin):
             self.get_report_request()
         except ReportRequest.DoesNotExist:
             raise Http404()
+        if getattr(self.report, 'live_view', False):
+            # live reports have no stored rows to export, the output streams from the report's query
+            return ReportView.as_view()(self.request, *self.args, **self.kwargs)
         status = self.check_report_status()
         if 'error' in status: #there was an error, try recreating the report
             #CONSIDER add max retries
@@ -306,7 +349,7 @@ class ReportExportView(TemplateView, RequestReportMixin):
                                       context_instance=RequestContext(self.request))
         
         #if the report is small enough there is no need to create a task to export
-        if self.report_request.rows.all().count() <=  MAX_ROWS_FOR_QUICK_EXPORT:
+        if self.report_request.get_result_store().get_rows().count() <=  MAX_ROWS_FOR_QUICK_EXPORT:
             return ReportView.as_view()(self.request, *self.args, **self.kwargs)
         
         self.get_report_export_request()
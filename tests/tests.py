@@ -13,10 +13,18 @@ import time
 from reports import CustomerReport, CustomerSalesReport, SaleItemReport, CustomerByStamp
 from datetime import datetime, timedelta
 from utils import first_names, last_names
+import os
 import random
 import reportengine
 import json
-from reportengine.outputformats import CSVOutputFormat
+from reportengine.outputformats import CSVOutputFormat, XLSXOutputFormat, XMLOutputFormat, JSONOutputFormat, \
+    NDJSONOutputFormat, ParquetOutputFormat, ArrowOutputFormat, XLS_AVAILABLE, XLSX_AVAILABLE, PARQUET_AVAILABLE
+from django.utils.unittest import skipUnless
+from reportengine.base import resolve_aggregates
+try:
+    from django.utils import timezone
+except ImportError:
+    timezone = None
 
 class CustomerFactory(factory.Factory):
     FACTORY_FOR = models.Customer
@@ -110,17 +118,17 @@ class ReportEngineTestCase(BaseTestCase):
     def test_modelreport(self):
         cr = CustomerReport()
         rows,metadata = cr.get_rows()
-        self.assertTrue(len(rows)==models.Customer.objects.count())
+        self.assertTrue(len(list(rows))==models.Customer.objects.count())
 
     def test_sqlreport(self):
         csr = CustomerSalesReport()
         rows, metadata = csr.get_rows(self.sql_filters)
-        self.assertEqual(rows[0][2], self.test_total)
+        self.assertEqual(list(rows)[0][2], self.test_total)
 
     def test_querysetreport(self):
         sir = SaleItemReport()
         rows, metadata = sir.get_rows()
-        self.assertEqual(models.SaleItem.objects.count(), len(rows))
+        self.assertEqual(models.SaleItem.objects.count(), len(list(rows)))
 
     def test_datesqlreport(self):
         cbs = CustomerByStamp()
@@ -129,7 +137,7 @@ class ReportEngineTestCase(BaseTestCase):
                                               'date__gte': (datetime.now()-timedelta(days=30)).strftime('%Y-%m-%d')
                                              })
 
-        self.assertEqual(len(rows), self.this_months_customers)
+        self.assertEqual(len(list(rows)), self.this_months_customers)
 
     def test_report(self):
         class CounterReport(reportengine.base.Report):
@@ -159,7 +167,8 @@ class ReportEngineTestCase(BaseTestCase):
         ctx['report'] = rnr
 
         then = time.clock()
-        csv.get_response(ctx,None)
+        for chunk in csv.get_response(ctx,None):
+            pass
         now = time.clock()
         result = now - then
 
@@ -180,4 +189,884 @@ class ReportEngineTestCase(BaseTestCase):
         result = rr.schedule_task()
         self.assertEqual(True,result.successful())
 
-        
+    def test_reportrequest_batched_rows(self):
+        from reportengine import models as re_models, resultstores
+        class CounterReport(reportengine.base.Report):
+            labels = ('number',)
+            def get_rows(self, *args, **kwargs):
+                return [(x,) for x in range(0,25)], (('total', 25,),)
+        rr = re_models.ReportRequest.objects.create(namespace='testing', slug='counter', params={})
+        rr.get_report = lambda: CounterReport()
+        batch_size = resultstores.REPORT_ROW_BATCH_SIZE
+        resultstores.REPORT_ROW_BATCH_SIZE = 7
+        try:
+            rr.build_report()
+        finally:
+            resultstores.REPORT_ROW_BATCH_SIZE = batch_size
+        rows = rr.rows.order_by('row_number')
+        self.assertEqual(25, rows.count())
+        self.assertEqual([[x] for x in range(0,25)], [r.data for r in rows])
+
+    def test_reportrequest_streamed_rows(self):
+        from reportengine.models import ReportRequest
+        class GeneratorReport(reportengine.base.Report):
+            labels = ('number',)
+            def get_rows(self, *args, **kwargs):
+                return ((x,) for x in xrange(0,1200)), (('total', 1200,),)
+        rr = ReportRequest.objects.create(namespace='testing', slug='generator', params={})
+        rr.get_report = lambda: GeneratorReport()
+        rr.build_report()
+        self.assertEqual(1200, rr.rows.count())
+        self.assertEqual([1199], rr.rows.get(row_number=1199).data)
+
+    def test_reportrequest_cache(self):
+        from reportengine.models import ReportRequest, ReportCacheStats, get_params_fingerprint
+        fingerprint = get_params_fingerprint('system', 'sale-report', self.sql_filters)
+        self.assertEqual(fingerprint, get_params_fingerprint('system', 'sale-report', dict(self.sql_filters, order_by='')))
+        self.assertNotEqual(fingerprint, get_params_fingerprint('system', 'sale-report', {}))
+        self.assertEqual(None, ReportRequest.objects.cached(fingerprint, 60))
+
+        rr = ReportRequest.objects.create(namespace='system', slug='sale-report', params=self.sql_filters,
+                                          token='cached', fingerprint=fingerprint)
+        self.assertEqual(None, ReportRequest.objects.cached(fingerprint, 60))
+        rr.build_report()
+        self.assertEqual(rr.pk, ReportRequest.objects.cached(fingerprint, 60).pk)
+        ReportRequest.objects.filter(pk=rr.pk).update(
+            completion_timestamp=datetime.now() - timedelta(seconds=120))
+        self.assertEqual(None, ReportRequest.objects.cached(fingerprint, 60))
+
+        ReportCacheStats.objects.record('system', 'sale-report', hit=True)
+        ReportCacheStats.objects.record('system', 'sale-report', hit=False)
+        ReportCacheStats.objects.record('system', 'sale-report', hit=True)
+        stats = ReportCacheStats.objects.get(namespace='system', slug='sale-report')
+        self.assertEqual((2, 1), (stats.hits, stats.misses))
+
+    def test_reportrequest_inflight(self):
+        from django.core.cache import cache
+        from reportengine.models import ReportRequest, get_params_fingerprint
+        cache.clear()
+        fingerprint = get_params_fingerprint('system', 'sale-report', self.sql_filters)
+        requests = [ReportRequest.objects.create(namespace='system', slug='sale-report', params=self.sql_filters,
+                                                 token='inflight%s' % i, fingerprint=fingerprint) for i in range(3)]
+        self.assertEqual(requests[0].pk, ReportRequest.objects.claim_inflight(requests[0]).pk)
+        self.assertEqual(requests[0].pk, ReportRequest.objects.claim_inflight(requests[1]).pk)
+        self.assertEqual(requests[0].pk, ReportRequest.objects.inflight(fingerprint).pk)
+        requests[0].build_report()
+        self.assertEqual(None, ReportRequest.objects.inflight(fingerprint))
+        self.assertEqual(requests[2].pk, ReportRequest.objects.claim_inflight(requests[2]).pk)
+        # a failed build is released too, so the next request doesn't wait for it
+        class FailingReport(CustomerSalesReport):
+            def get_rows(self, filters={}, order_by=None):
+                raise ValueError('report failed')
+        requests[2].get_report = lambda: FailingReport()
+        self.assertRaises(ValueError, requests[2].build_report)
+        self.assertEqual(None, ReportRequest.objects.inflight(fingerprint))
+
+    def test_reportrequest_chunk_storage(self):
+        from reportengine import models as re_models, resultstores
+        from reportengine.resultstores import ReportChunkQuery, ReportRowQuery
+        class CounterReport(reportengine.base.Report):
+            labels = ('number',)
+            def get_rows(self, *args, **kwargs):
+                return ((x, 'row %s' % x) for x in range(0,25)), (('total', 25,),)
+        rr = re_models.ReportRequest.objects.create(namespace='testing', slug='counter', params={}, token='chunks')
+        rr.get_report = lambda: CounterReport()
+        settings = (re_models.REPORT_ROW_STORAGE, resultstores.REPORT_ROW_BATCH_SIZE)
+        re_models.REPORT_ROW_STORAGE, resultstores.REPORT_ROW_BATCH_SIZE = 'chunks', 10
+        try:
+            rr.build_report()
+        finally:
+            re_models.REPORT_ROW_STORAGE, resultstores.REPORT_ROW_BATCH_SIZE = settings
+        self.assertEqual(0, rr.rows.count())
+        self.assertEqual(3, rr.chunks.count())
+        rows = rr.get_result_store().get_rows()
+        self.assertTrue(isinstance(rows, ReportChunkQuery))
+        self.assertEqual(25, rows.count())
+        self.assertEqual([[x, 'row %s' % x] for x in range(8,22)], rows[8:22])
+        self.assertEqual([24, 'row 24'], rows[-1])
+        self.assertEqual([[x, 'row %s' % x] for x in range(0,25)], list(rows))
+
+        rr.convert_storage('rows')
+        self.assertEqual(0, rr.chunks.count())
+        rows = re_models.ReportRequest.objects.get(pk=rr.pk).get_result_store().get_rows()
+        self.assertTrue(isinstance(rows, ReportRowQuery))
+        self.assertEqual([[x, 'row %s' % x] for x in range(0,25)], list(rows))
+
+    def test_reportrequest_file_storage(self):
+        import shutil, tempfile
+        from reportengine import models as re_models, resultstores
+        class CounterReport(reportengine.base.Report):
+            labels = ('number',)
+            def get_rows(self, *args, **kwargs):
+                return ((x, u'r\xf6w\n%s' % x) for x in range(0,25)), (('total', 25,),)
+        rr = re_models.ReportRequest.objects.create(namespace='testing', slug='counter', params={}, token='file')
+        rr.get_report = lambda: CounterReport()
+        settings = (re_models.REPORT_ROW_STORAGE, resultstores.REPORT_RESULT_FILE_ROOT)
+        re_models.REPORT_ROW_STORAGE, resultstores.REPORT_RESULT_FILE_ROOT = 'file', tempfile.mkdtemp()
+        try:
+            rr.build_report()
+            rows = rr.get_result_store().get_rows()
+            self.assertTrue(isinstance(rows, resultstores.ReportFileQuery))
+            self.assertEqual(25, rows.count())
+            self.assertEqual([[x, u'r\xf6w\n%s' % x] for x in range(3,9)], rows[3:9])
+            self.assertEqual([24, u'r\xf6w\n24'], rows[-1])
+            self.assertEqual([[x, u'r\xf6w\n%s' % x] for x in range(0,25)], list(rows))
+            rows.close()
+            rr.delete()
+            self.assertEqual([], os.listdir(resultstores.REPORT_RESULT_FILE_ROOT))
+        finally:
+            shutil.rmtree(resultstores.REPORT_RESULT_FILE_ROOT)
+            re_models.REPORT_ROW_STORAGE, resultstores.REPORT_RESULT_FILE_ROOT = settings
+
+    def test_reportrowquery_slicing(self):
+        from reportengine.models import ReportRequest
+        class CounterReport(reportengine.base.Report):
+            labels = ('number',)
+            def get_rows(self, *args, **kwargs):
+                return ((x,) for x in range(0,30)), (('total', 30,),)
+        rr = ReportRequest.objects.create(namespace='testing', slug='counter', params={}, token='keyset')
+        rr.get_report = lambda: CounterReport()
+        rr.build_report()
+        rows = rr.get_result_store().get_rows()
+        self.assertEqual(30, len(rows))
+        self.assertEqual([[x] for x in range(20,30)], rows[20:40])
+        self.assertEqual([[x] for x in range(25,30)], rows[25:])
+        self.assertEqual([[x] for x in range(0,10,3)], rows[:10:3])
+        self.assertEqual([], rows[40:50])
+        self.assertEqual([29], rows[-1])
+        self.assertRaises(IndexError, lambda: rows[30])
+
+    def test_reportrequest_row_count(self):
+        from reportengine.models import ReportRequest
+        class CounterReport(reportengine.base.Report):
+            labels = ('number',)
+            def get_rows(self, *args, **kwargs):
+                return ((x,) for x in range(0,30)), (('total', 30,),)
+        rr = ReportRequest.objects.create(namespace='testing', slug='counter', params={}, token='count')
+        rr.get_report = lambda: CounterReport()
+        rr.build_report()
+        rr = ReportRequest.objects.get(pk=rr.pk)
+        self.assertEqual(30, rr.row_count)
+        self.assertEqual(sum(len(json.dumps([x])) for x in range(0,30)), rr.byte_size)
+        rows = rr.get_result_store().get_rows()
+        with self.assertNumQueries(0):
+            self.assertEqual(30, rows.count())
+            self.assertEqual(30, len(rows))
+        with self.assertNumQueries(1):
+            self.assertEqual([[x] for x in range(20,30)], rows[20:])
+
+    def test_streamingcsvoutput(self):
+        from cStringIO import StringIO
+        class CounterReport(reportengine.base.Report):
+            slug = 'counter'
+            labels = ('number', 'name')
+        ctx = {'rows': ((x, u'n\xe4me %s' % x) for x in range(0,25)),
+               'aggregates': [('total', 25)],
+               'report': CounterReport()}
+        csv = CSVOutputFormat()
+        chunks = list(csv.iter_output(ctx, chunk_rows=10))
+        self.assertEqual(3, len(chunks))
+        output = StringIO()
+        csv.generate_output(dict(ctx, rows=((x, u'n\xe4me %s' % x) for x in range(0,25))), output)
+        self.assertEqual(output.getvalue(), ''.join(chunks))
+        self.assertTrue(chunks[0].startswith('total,25\nnumber,name\n0,n\xc3\xa4me 0\n'))
+        self.assertEqual('counter.csv', csv.get_filename(ctx))
+
+    @skipUnless(XLSX_AVAILABLE, 'requires xlsxwriter')
+    def test_xlsxoutput_sheet_rollover(self):
+        import re
+        import zipfile
+        from cStringIO import StringIO
+        class CounterReport(reportengine.base.Report):
+            slug = 'counter'
+            labels = ('number', 'name', 'stamp')
+        xlsx = XLSXOutputFormat()
+        xlsx.max_sheet_rows = 10
+        ctx = {'rows': ((x, u'=n\xe4me %s' % x, datetime(2013, 1, 1)) for x in range(0,25)),
+               'aggregates': [('total', 25)],
+               'report': CounterReport()}
+        data = ''.join(xlsx.iter_output(ctx))
+        workbook = zipfile.ZipFile(StringIO(data))
+        sheets = sorted(n for n in workbook.namelist() if n.startswith('xl/worksheets/sheet'))
+        self.assertEqual(['xl/worksheets/sheet1.xml', 'xl/worksheets/sheet2.xml', 'xl/worksheets/sheet3.xml'], sheets)
+        self.assertTrue('<f>' not in workbook.read('xl/worksheets/sheet1.xml'))
+        # aggregates come before the labels, as in the other formats, later sheets start with the labels
+        def first_cells(sheet):
+            return re.findall(r'<row r="\d+"><c r="A\d+" t="inlineStr"><is><t>(\w+)</t>', workbook.read(sheet))[:2]
+        self.assertEqual(['total', 'number'], first_cells('xl/worksheets/sheet1.xml'))
+        self.assertEqual(['number'], first_cells('xl/worksheets/sheet2.xml')[:1])
+
+    @skipUnless(XLSX_AVAILABLE and timezone, 'requires xlsxwriter and time zone support')
+    def test_xlsxoutput_use_tz(self):
+        import zipfile
+        from cStringIO import StringIO
+        from django.test.utils import override_settings
+        class StampReport(reportengine.base.Report):
+            slug = 'stamps'
+            labels = ('stamp', 'typed_stamp')
+            column_types = {'typed_stamp': 'datetime'}
+        def sheet(stamp):
+            ctx = {'rows': [(stamp, stamp)], 'aggregates': [('latest', stamp)], 'report': StampReport()}
+            return zipfile.ZipFile(StringIO(''.join(XLSXOutputFormat().iter_output(ctx)))).read('xl/worksheets/sheet1.xml')
+        stamp = timezone.make_aware(datetime(2013, 1, 2, 3, 4, 5), timezone.utc)
+        with override_settings(USE_TZ=True):
+            # aware datetimes are written in local time, as Excel has no time zones
+            self.assertEqual(sheet(timezone.make_naive(stamp, timezone.get_current_timezone())), sheet(stamp))
+
+    def test_streamingxmloutput(self):
+        from xml.etree import ElementTree as ET
+        class CounterReport(reportengine.base.Report):
+            slug = 'counter'
+            labels = ('number', 'name')
+        ctx = {'rows': ((x, u'<n\xe4me %s>' % x) for x in range(0,25)),
+               'aggregates': [('total', 25)],
+               'report': CounterReport()}
+        chunks = list(XMLOutputFormat(row_tag='row').iter_output(ctx, chunk_rows=10))
+        self.assertEqual(3, len(chunks))
+        root = ET.fromstring(''.join(chunks))
+        self.assertEqual('25', root.find('aggregate').text)
+        self.assertEqual(25, len(root.findall('row')))
+        self.assertEqual(u'<n\xe4me 24>', root.findall('row')[-1].find('name').text)
+
+    def test_jsonoutput(self):
+        class CounterReport(reportengine.base.Report):
+            slug = 'counter'
+            labels = ('number', 'price', 'stamp', 'name')
+        def ctx():
+            return {'rows': ((x, decimal.Decimal('1.50'), datetime(2013, 1, 2, 3, 4, 5), u'n\xe4me') for x in range(0,3)),
+                    'aggregates': [('total', 3)],
+                    'report': CounterReport()}
+        data = json.loads(''.join(JSONOutputFormat().iter_output(ctx())))
+        self.assertEqual(['number', 'price', 'stamp', 'name'], data['labels'])
+        self.assertEqual([['total', 3]], data['aggregates'])
+        self.assertEqual([2, 1.5, '2013-01-02T03:04:05', u'n\xe4me'], data['rows'][2])
+        lines = ''.join(NDJSONOutputFormat().iter_output(ctx())).splitlines()
+        self.assertEqual(4, len(lines))
+        self.assertEqual([['total', 3]], json.loads(lines[0])['aggregates'])
+        self.assertEqual([0, 1.5, '2013-01-02T03:04:05', u'n\xe4me'], json.loads(lines[1]))
+
+    @skipUnless(PARQUET_AVAILABLE, 'pyarrow is not installed')
+    def test_parquetoutput(self):
+        import pyarrow
+        import pyarrow.parquet
+        from cStringIO import StringIO
+        class CounterReport(reportengine.base.Report):
+            slug = 'counter'
+            labels = ('number', 'price', 'stamp', 'name')
+        def ctx():
+            return {'rows': ((x, decimal.Decimal('1.50'), datetime(2013, 1, 2, 3, 4, 5), u'n\xe4me %s' % x) for x in range(0,25)),
+                    'aggregates': [('total', 25)],
+                    'report': CounterReport()}
+        data = ''.join(ParquetOutputFormat(row_group_size=10).iter_output(ctx()))
+        parquet_file = pyarrow.parquet.ParquetFile(StringIO(data))
+        self.assertEqual(3, parquet_file.num_row_groups)
+        table = parquet_file.read()
+        self.assertEqual([u'number', u'price', u'stamp', u'name'], table.schema.names)
+        self.assertEqual(pyarrow.int64(), table.schema.field_by_name('number').type)
+        self.assertEqual(pyarrow.float64(), table.schema.field_by_name('price').type)
+        self.assertEqual([['total', 25]], json.loads(table.schema.metadata['reportengine.aggregates']))
+        columns = table.to_pydict()
+        self.assertEqual(range(0, 25), columns['number'])
+        self.assertEqual(datetime(2013, 1, 2, 3, 4, 5), columns['stamp'][24])
+        self.assertEqual(u'n\xe4me 24', columns['name'][24])
+        data = ''.join(ArrowOutputFormat().iter_output(ctx()))
+        self.assertEqual(25, pyarrow.ipc.open_file(pyarrow.BufferReader(data)).read_all().num_rows)
+        # numbers that don't fit the type of the first row group are never truncated
+        def mixed_ctx(report):
+            return {'rows': [(1, u'a')] * 10 + [(2.7, u'b'), (u'x', u'c')], 'aggregates': [], 'report': report}
+        class MixedReport(reportengine.base.Report):
+            labels = ('number', 'name')
+        self.assertRaises(ValueError, lambda: ''.join(ParquetOutputFormat(row_group_size=10).iter_output(
+            mixed_ctx(MixedReport()))))
+        # unless the column type says they are floats
+        class FloatReport(MixedReport):
+            column_types = {'number': 'float'}
+        context = mixed_ctx(FloatReport())
+        context['rows'] = context['rows'][:-1]
+        table = pyarrow.parquet.read_table(StringIO(''.join(ParquetOutputFormat(row_group_size=10).iter_output(context))))
+        self.assertEqual(pyarrow.float64(), table.schema.field_by_name('number').type)
+        self.assertEqual(2.7, table.to_pydict()['number'][10])
+
+    def test_compressedexports(self):
+        import gzip
+        import shutil
+        import tempfile
+        from cStringIO import StringIO
+        from django.core.files.storage import FileSystemStorage
+        from django.test.client import RequestFactory
+        from reportengine.models import ReportRequest, ReportRequestExport
+        class CounterReport(reportengine.base.Report):
+            slug = 'counter'
+            labels = ('number',)
+            def get_rows(self, *args, **kwargs):
+                return ((x,) for x in range(0,100)), (('total', 100),)
+        expected = ''.join(CSVOutputFormat().iter_output({'rows': [(x,) for x in range(0,100)],
+                                                          'aggregates': [('total', 100)],
+                                                          'report': CounterReport()}))
+        def ctx():
+            rows, aggregates = CounterReport().get_rows()
+            return {'rows': rows, 'aggregates': aggregates, 'report': CounterReport()}
+
+        resp = CSVOutputFormat().get_response(ctx(), RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip;q=1.0, identity'))
+        self.assertEqual('gzip', resp['Content-Encoding'])
+        self.assertEqual(expected, gzip.GzipFile(fileobj=StringIO(''.join(resp))).read())
+        resp = CSVOutputFormat().get_response(ctx(), RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip;q=0'))
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertEqual(expected, ''.join(resp))
+
+        payload_field = ReportRequestExport._meta.get_field('payload')
+        old_storage = payload_field.storage
+        media_root = tempfile.mkdtemp()
+        payload_field.storage = FileSystemStorage(location=media_root)
+        try:
+            rr = ReportRequest.objects.create(namespace='testing', slug='counter', params={})
+            rr.get_report = lambda: CounterReport()
+            rr.build_report()
+            export = ReportRequestExport(report_request=rr, format='csv', token='counter-csv')
+            export.report_request = rr
+            export.build_report()
+            self.assertTrue(export.payload.name.endswith('counter.csv.gz'))
+            self.assertEqual(expected, gzip.GzipFile(fileobj=StringIO(export.payload.read())).read())
+            export.payload.close()
+        finally:
+            payload_field.storage = old_storage
+            shutil.rmtree(media_root)
+
+    def test_exportfanout(self):
+        import gzip
+        import shutil
+        import tempfile
+        from cStringIO import StringIO
+        from django.core.files.storage import FileSystemStorage
+        from django.db import IntegrityError, transaction
+        from reportengine.models import ReportRequest, ReportRequestExport
+        from reportengine.views import ReportExportView
+        class CounterReport(reportengine.base.Report):
+            slug = 'counter'
+            labels = ('number',)
+            output_formats = reportengine.base.Report.output_formats + [XMLOutputFormat()]
+            def get_rows(self, *args, **kwargs):
+                return ((x,) for x in range(0,100)), (('total', 100),)
+        class CountingRows(list):
+            passes = 0
+            def __iter__(self):
+                CountingRows.passes += 1
+                return super(CountingRows, self).__iter__()
+
+        payload_field = ReportRequestExport._meta.get_field('payload')
+        old_storage = payload_field.storage
+        media_root = tempfile.mkdtemp()
+        payload_field.storage = FileSystemStorage(location=media_root)
+        try:
+            rr = ReportRequest.objects.create(namespace='testing', slug='counter', params={}, token='counter')
+            rr.get_report = lambda: CounterReport()
+            rr.build_report()
+            store = rr.get_result_store()
+            stored_rows = list(store.get_rows())
+            store.get_rows = lambda: CountingRows(stored_rows)
+            rr.get_result_store = lambda: store
+            exports = ReportRequestExport.objects.build_exports(rr, ['csv', 'xml', 'json', 'nonexistent'], 'prebuild')
+            self.assertEqual(1, CountingRows.passes)
+            self.assertEqual(['csv', 'xml', 'json'], [e.format for e in exports])
+            # the task is recorded, so the export views see it fail
+            self.assertEqual(['prebuild'] * 3, [e.task for e in rr.exports.all()])
+            self.assertEqual(3, rr.exports.filter(completion_timestamp__isnull=False).count())
+            payloads = dict((e.format, gzip.GzipFile(fileobj=StringIO(e.payload.read())).read()) for e in exports)
+            self.assertEqual(range(0, 100), [row[0] for row in json.loads(payloads['json'])['rows']])
+            self.assertTrue(payloads['csv'].endswith('98\n99\n'))
+            self.assertTrue(payloads['xml'].endswith('</output>'))
+            # complete exports are reused
+            self.assertEqual([e.pk for e in exports[:1]], [e.pk for e in ReportRequestExport.objects.build_exports(rr, ['csv'])])
+            self.assertEqual(1, CountingRows.passes)
+            # there is one export per format, whoever asks for it first
+            export, created = ReportRequestExport.objects.get_export(rr, 'csv')
+            self.assertEqual((exports[0].pk, False), (export.pk, created))
+            sid = transaction.savepoint()
+            self.assertRaises(IntegrityError, ReportRequestExport.objects.create, report_request=rr, format='csv',
+                              token='duplicate')
+            transaction.savepoint_rollback(sid)
+            # an export left incomplete without a task is built by the next export view
+            orphan, created = ReportRequestExport.objects.get_export(rr, 'ndjson')
+            view = ReportExportView(kwargs={'output': 'ndjson'}, asynchronous_report=False)
+            view.report_request = rr
+            view.get_report_export_request()
+            self.assertEqual(orphan.pk, view.report_export_request.pk)
+            self.assertTrue(view.report_export_request.completion_timestamp)
+            view.report_export_request.payload.close()
+            for e in exports:
+                e.payload.close()
+        finally:
+            payload_field.storage = old_storage
+            shutil.rmtree(media_root)
+
+    def test_columntypes(self):
+        self.assertEqual(['text', 'text', 'text', 'decimal'], SaleItemReport().get_column_types())
+        self.assertEqual(['datetime', 'text', 'text'], CustomerReport().get_column_types())
+        class SaleReport(reportengine.base.QuerySetReport):
+            labels = ('customer', 'customer__age', 'total', 'item_count')
+            column_types = {'total': 'float', 'item_count': 'integer'}
+            queryset = models.Sale.objects.all()
+        self.assertEqual(['integer', 'integer', 'float', 'integer'], SaleReport().get_column_types())
+        self.assertEqual([None, None, None], CustomerSalesReport().get_column_types())
+
+        class TypedReport(reportengine.base.Report):
+            slug = 'typed'
+            labels = ('number', 'price', 'stamp', 'name')
+            column_types = {'number': 'integer', 'price': 'decimal', 'stamp': 'datetime', 'name': 'text'}
+        class UntypedReport(TypedReport):
+            column_types = {}
+        rows = [(1, decimal.Decimal('1.50'), datetime(2013, 1, 2, 3, 4, 5), u'n\xe4me'),
+                (None, '1.50', '2013-01-02T03:04:05', 'name', 'extra')]
+        for output_format in (CSVOutputFormat(), XMLOutputFormat()):
+            typed = ''.join(output_format.iter_output({'rows': rows, 'aggregates': [], 'report': TypedReport()}))
+            untyped = ''.join(output_format.iter_output({'rows': rows, 'aggregates': [], 'report': UntypedReport()}))
+            self.assertEqual(untyped, typed)
+        self.assertTrue(typed.startswith('<?xml'))
+
+    def test_sqlreport_server_side_cursor(self):
+        class FakeCursor(object):
+            def __init__(self, name=None, withhold=False):
+                self.name, self.withhold = name, withhold
+                self.rows = [(x,) for x in range(0, 25)]
+                self.fetches = []
+                self.closed = False
+            def execute(self, sql):
+                self.sql = sql
+            def fetchmany(self, size):
+                self.fetches.append(size)
+                rows, self.rows = self.rows[:size], self.rows[size:]
+                return rows
+            def close(self):
+                self.closed = True
+        class FakeConnection(object):
+            vendor = 'postgresql'
+            class features:
+                can_use_chunked_reads = True
+            def __init__(self):
+                self.connection = self
+                self.cursors = []
+            def cursor(self, **kwargs):
+                self.cursors.append(FakeCursor(**kwargs))
+                return self.cursors[-1]
+        connection = FakeConnection()
+        class CounterReport(reportengine.base.SQLReport):
+            row_sql = 'SELECT number FROM counter'
+            fetch_size = 10
+            def get_connection(self):
+                return connection
+        rows, aggregates = CounterReport().get_rows()
+        self.assertFalse(isinstance(rows, list))
+        self.assertEqual(range(0, 25), [row[0] for row in rows])
+        cursor = connection.cursors[-1]
+        self.assertTrue(cursor.withhold)
+        self.assertTrue(cursor.name.startswith('reportengine_'))
+        self.assertEqual(10, cursor.itersize)
+        self.assertEqual([10, 10, 10, 10], cursor.fetches)
+        self.assertTrue(cursor.closed)
+
+    def test_sqlreport_bind_params(self):
+        from reportengine.base import compile_statement
+        self.assertEqual(("SELECT * FROM t WHERE a = %s AND b LIKE 'x%%' AND c < %s OR a = %s", ['a', 'c', 'a']),
+                         compile_statement("SELECT * FROM t WHERE a = %(a)s AND b LIKE 'x%%' AND c < %(c)s OR a = %(a)s"))
+        class BoundCustomerByStamp(CustomerByStamp):
+            bind_params = True
+            row_sql = """
+                SELECT first_name, last_name, stamp FROM tests_customer
+                WHERE stamp < %(date__lt)s AND stamp >= %(date__gte)s AND first_name LIKE '%%'
+            """
+            aggregate_sql = """
+                SELECT COUNT(*) AS total FROM tests_customer WHERE stamp < %(date__lt)s AND stamp >= %(date__gte)s
+            """
+        report = BoundCustomerByStamp()
+        filters = {'date__gte': '2000-01-01', 'date__lt': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        sql, params = report.get_statement(report.get_row_sql(filters, None), filters)
+        self.assertTrue('%(' not in sql)
+        self.assertEqual([datetime.strptime(filters['date__lt'], '%Y-%m-%d %H:%M:%S'), datetime(2000, 1, 1)], params)
+        rows, aggregates = report.get_rows(filters)
+        self.assertEqual(models.Customer.objects.filter(stamp__gte=datetime(2000, 1, 1)).count(), len(list(rows)))
+        self.assertEqual([('total', 100)], aggregates)
+
+    def test_sqlreport_live_view(self):
+        from django.core.paginator import Paginator
+        from reportengine.base import SQLReportRowQuery
+        from reportengine.models import ReportRequest
+        class LiveCustomerReport(reportengine.base.SQLReport):
+            live_view = True
+            bind_params = True
+            labels = ('first_name', 'age')
+            row_sql = "SELECT first_name, age FROM tests_customer WHERE age >= %(min_age)s;"
+            query_params = [('min_age', 'Minimum age', 'char')]
+        report = LiveCustomerReport()
+        rr = ReportRequest(namespace='testing', slug='live', params={'min_age': '30'})
+        filters = rr.get_filters(report)
+        self.assertEqual({'min_age': u'30'}, filters)
+        expected = list(models.Customer.objects.filter(age__gte=30).order_by('-age').values_list('age', flat=True))
+        rows = SQLReportRowQuery(report, filters, '-age')
+        self.assertEqual(len(expected), rows.count())
+        self.assertEqual(expected[:10], [row[1] for row in rows[:10]])
+        self.assertEqual(expected[5:8], [row[1] for row in rows[5:8]])
+        self.assertEqual(expected[-1], rows[-1][1])
+        self.assertEqual(expected, [row[1] for row in rows])
+        page = Paginator(rows, 7).page(2)
+        self.assertEqual(expected[7:14], [row[1] for row in page.object_list])
+        # unknown labels don't get into the SQL
+        self.assertEqual('', report.get_order_by_sql('age; DROP TABLE tests_customer'))
+        self.assertRaises(IndexError, lambda: rows[len(expected)])
+        # requests of live reports are complete straight away, so they are cleaned up once stale
+        from django.test.client import RequestFactory
+        from reportengine.views import RequestReportView
+        get_absolute_url = ReportRequest.get_absolute_url
+        ReportRequest.get_absolute_url = lambda self: '/'
+        reportengine._registry[('testing', 'live')] = LiveCustomerReport
+        try:
+            response = RequestReportView.as_view()(RequestFactory().post('/', {'min_age': '30'}),
+                                                   namespace='testing', slug='live')
+        finally:
+            ReportRequest.get_absolute_url = get_absolute_url
+            del reportengine._registry[('testing', 'live')]
+        self.assertEqual(302, response.status_code)
+        rr = ReportRequest.objects.get(namespace='testing', slug='live')
+        self.assertTrue(rr.completion_timestamp)
+        ReportRequest.objects.filter(pk=rr.pk).update(request_made=datetime(2000, 1, 1),
+                                                      completion_timestamp=datetime(2000, 1, 1))
+        self.assertEqual([rr.pk], [stale.pk for stale in ReportRequest.objects.stale()])
+
+    def test_sqlreport_concurrent_aggregates(self):
+        import threading
+        rows_fetched = threading.Event()
+        aggregates_started = threading.Event()
+        overlapped = []
+        class ConcurrentReport(reportengine.base.SQLReport):
+            concurrent_aggregates = True
+            def can_query_concurrently(self):
+                return True
+            def get_row_data(self, filters, order_by):
+                # like a named cursor on PostgreSQL, the rows are only produced as they are fetched
+                def fetch():
+                    aggregates_started.wait(5)
+                    rows_fetched.set()
+                    yield (1,)
+                    yield (2,)
+                return fetch()
+            def get_aggregate_data(self, filters):
+                aggregates_started.set()
+                # the aggregate query is still running while the rows are fetched
+                overlapped.append(rows_fetched.wait(5))
+                if filters.get('fail'):
+                    raise ValueError('aggregate failed')
+                return [('total', 2)]
+        rows, aggregates = ConcurrentReport().get_rows({})
+        self.assertEqual([(1,), (2,)], list(rows))
+        self.assertEqual([True], overlapped)
+        self.assertEqual([('total', 2)], resolve_aggregates(aggregates))
+        rows, aggregates = ConcurrentReport().get_rows({'fail': True})
+        self.assertEqual([(1,), (2,)], list(rows))
+        self.assertRaises(ValueError, resolve_aggregates, aggregates)
+        # the in-memory test database isn't shared with other threads
+        self.assertFalse(CustomerSalesReport().can_query_concurrently())
+
+    def test_report_database(self):
+        from django.db import connection
+        from django.db.utils import ConnectionDoesNotExist
+        from reportengine import base
+        class ReplicaSaleItemReport(SaleItemReport):
+            using = 'replica'
+        class ReplicaSalesReport(CustomerSalesReport):
+            using = 'replica'
+        self.assertEqual(None, SaleItemReport().get_database())
+        self.assertEqual('replica', ReplicaSaleItemReport().get_database())
+        self.assertEqual(connection.alias, CustomerSalesReport().get_connection().alias)
+        # the queryset and cursors of the report go to the replica, which isn't configured here
+        self.assertRaises(ConnectionDoesNotExist, lambda: list(ReplicaSaleItemReport().get_rows()[0]))
+        self.assertRaises(ConnectionDoesNotExist, ReplicaSalesReport().get_cursor)
+        old_database = base.REPORT_DATABASE
+        base.REPORT_DATABASE = 'default'
+        try:
+            self.assertEqual('default', SaleItemReport().get_database())
+            rows, aggregates = SaleItemReport().get_rows()
+            self.assertEqual(models.SaleItem.objects.count(), len(list(rows)))
+        finally:
+            base.REPORT_DATABASE = old_database
+
+    def test_query_cost_guard(self):
+        from django.db import connection, DatabaseError
+        from django.test.client import RequestFactory
+        from reportengine.base import QueryCostExceeded, explain_query, set_statement_timeout
+        from reportengine.models import ReportRequest
+        from reportengine.views import RequestReportView
+        class GuardedSaleItemReport(SaleItemReport):
+            max_estimated_rows = 10
+            def get_query_estimate(self, filters, order_by=None):
+                return {'rows': models.SaleItem.objects.count(), 'cost': None}
+        class TimeoutSaleItemReport(GuardedSaleItemReport):
+            cost_guard_action = 'timeout'
+        # sqlite has no estimates, so the guard lets everything through
+        self.assertEqual(None, explain_query(connection, 'SELECT 1'))
+        self.assertEqual((None, None), SaleItemReport().check_query_cost({}))
+        action, message = GuardedSaleItemReport().check_query_cost({})
+        self.assertEqual('reject', action)
+        self.assertTrue('more than the 10 allowed' in message)
+        rr = ReportRequest.objects.create(token='guarded', namespace='testing', slug='guarded', params={})
+        rr.get_report = lambda: GuardedSaleItemReport()
+        self.assertRaises(QueryCostExceeded, rr.build_report)
+        self.assertEqual(None, rr.completion_timestamp)
+        rr.get_report = lambda: TimeoutSaleItemReport()
+        rr.build_report()
+        self.assertEqual(models.SaleItem.objects.count(), rr.row_count)
+        # rejections are shown on the filter form
+        class GuardedRequestReportView(RequestReportView):
+            def get_report_class(self):
+                return GuardedSaleItemReport
+        response = GuardedRequestReportView.as_view()(RequestFactory().post('/'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([message], response.context_data['filter_form'].non_field_errors())
+        self.assertFalse(ReportRequest.objects.exclude(pk=rr.pk).exists())
+        # including reports without filters, which are requested straight away on GET
+        response = GuardedRequestReportView.as_view()(RequestFactory().get('/'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([message], response.context_data['filter_form'].non_field_errors())
+        self.assertFalse(ReportRequest.objects.exclude(pk=rr.pk).exists())
+        class SlowSaleItemReport(GuardedSaleItemReport):
+            cost_guard_action = 'slow_queue'
+            slow_queue = 'slow'
+        class SlowRequestReportView(RequestReportView):
+            asynchronous_report = True
+        queues = []
+        schedule_task, get_absolute_url = ReportRequest.schedule_task, ReportRequest.get_absolute_url
+        ReportRequest.schedule_task = lambda self, queue=None: queues.append(queue)
+        ReportRequest.get_absolute_url = lambda self: '/'
+        reportengine._registry[('testing', 'slow')] = SlowSaleItemReport
+        try:
+            response = SlowRequestReportView.as_view()(RequestFactory().get('/'), namespace='testing', slug='slow')
+        finally:
+            ReportRequest.schedule_task, ReportRequest.get_absolute_url = schedule_task, get_absolute_url
+            del reportengine._registry[('testing', 'slow')]
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(['slow'], queues)
+        # lifting the timeout goes back to the configured one, rather than to none at all
+        class FakeConnection(object):
+            def __init__(self, vendor):
+                self.vendor = vendor
+                self.statements = []
+                self.aborted = False
+            def rollback(self):
+                self.statements.append('ROLLBACK')
+                self.aborted = False
+            def cursor(self):
+                connection = self
+                class Cursor(object):
+                    def execute(self, sql):
+                        if connection.aborted:
+                            raise DatabaseError('current transaction is aborted')
+                        connection.statements.append(sql)
+                    def close(self):
+                        pass
+                return Cursor()
+        postgresql, mysql = FakeConnection('postgresql'), FakeConnection('mysql')
+        for fake in (postgresql, mysql):
+            set_statement_timeout(fake, 1000)
+            set_statement_timeout(fake, None)
+        self.assertEqual(['SET statement_timeout = 1000', 'RESET statement_timeout'], postgresql.statements)
+        self.assertEqual(['SET SESSION max_execution_time = 1000', 'SET SESSION max_execution_time = DEFAULT'],
+                         mysql.statements)
+        # a query running into the timeout aborts the transaction, which is rolled back before the timeout is lifted,
+        # and the error of the query is the one raised
+        class QueryCanceledError(Exception):
+            pass
+        class CanceledSaleItemReport(TimeoutSaleItemReport):
+            def get_connection(self):
+                return postgresql
+            def get_rows(self, *args, **kwargs):
+                postgresql.aborted = True
+                raise QueryCanceledError('canceling statement due to statement timeout')
+        postgresql.statements = []
+        rr.get_report = lambda: CanceledSaleItemReport()
+        self.assertRaises(QueryCanceledError, rr.build_report)
+        self.assertEqual(['SET statement_timeout = %d' % CanceledSaleItemReport.statement_timeout, 'ROLLBACK',
+                          'RESET statement_timeout'], postgresql.statements)
+        # nor is it replaced by an error lifting the timeout
+        postgresql.rollback = lambda: None
+        self.assertRaises(QueryCanceledError, rr.build_report)
+
+    def test_querysetreport_lazy_total(self):
+        from reportengine.models import ReportRequest
+        count = models.SaleItem.objects.count()
+        rows, aggregates = SaleItemReport().get_rows()
+        # the rows are counted as they stream by, instead of in a separate COUNT query
+        with self.assertNumQueries(1):
+            self.assertEqual(count, len(list(rows)))
+        with self.assertNumQueries(0):
+            self.assertEqual([('total', count)], resolve_aggregates(aggregates))
+        # asked for before the rows, the total is counted in the database, once
+        rows, aggregates = SaleItemReport().get_rows()
+        with self.assertNumQueries(1):
+            self.assertEqual(count, int(aggregates[0][1]))
+            self.assertEqual(count, aggregates[0][1])
+        rr = ReportRequest.objects.create(token='lazytotal', namespace='testing', slug='lazytotal', params={})
+        rr.get_report = lambda: SaleItemReport()
+        rr.build_report()
+        self.assertEqual([['total', count]], ReportRequest.objects.get(pk=rr.pk).aggregates)
+
+    def test_querysetreport_aggregates(self):
+        from django.db.models import Avg, Max, Sum
+        from reportengine.models import ReportRequest
+        class SaleItemTotalsReport(SaleItemReport):
+            aggregates = {'revenue': Sum('price'), 'avg_price': Avg('price')}
+        class OrderedSaleItemTotalsReport(SaleItemReport):
+            aggregates = [('revenue', Sum('price')), ('max_price', Max('price'))]
+        items = models.SaleItem.objects.all()
+        revenue = sum(item.price for item in items)
+        # all aggregates come from one query, next to the row query
+        with self.assertNumQueries(2):
+            rows, aggregates = SaleItemTotalsReport().get_rows()
+            self.assertEqual(len(items), len(list(rows)))
+        self.assertEqual([('total', len(items)), ('avg_price', revenue / len(items)), ('revenue', revenue)],
+                         resolve_aggregates(aggregates))
+        rows, aggregates = OrderedSaleItemTotalsReport().get_rows()
+        self.assertEqual(['total', 'revenue', 'max_price'], [name for name, value in aggregates])
+        # and are stored on the request, for the views and output formats
+        rr = ReportRequest.objects.create(token='aggregates', namespace='testing', slug='aggregates', params={})
+        rr.get_report = lambda: SaleItemTotalsReport()
+        rr.build_report()
+        rr = ReportRequest.objects.get(pk=rr.pk)
+        self.assertEqual(['total', 'avg_price', 'revenue'], [name for name, value in rr.aggregates])
+        self.assertEqual(revenue, decimal.Decimal(rr.aggregates[2][1]))
+        output = ''.join(JSONOutputFormat().iter_output({'report': SaleItemTotalsReport(), 'rows': [],
+                                                         'aggregates': rr.aggregates}))
+        self.assertEqual(rr.aggregates, json.loads(output)['aggregates'])
+
+    def test_groupedquerysetreport(self):
+        from django.db.models import Count, Sum
+        sale = models.Sale.objects.all()[0]
+        for department, option2, price in ((u"Women's", 'Small', '10.00'), (u"Women's", 'Medium', '12.50'),
+                                           (u'100%', 'Small', '3.00')):
+            SaleItemFactory(sale=sale, department=department, option2=option2, price=decimal.Decimal(price))
+        items = list(models.SaleItem.objects.all())
+        def revenue(**kwargs):
+            return sum(i.price for i in items if all(getattr(i, k) == v for k, v in kwargs.items())) or None
+        class DepartmentReport(reportengine.base.GroupedQuerySetReport):
+            queryset = models.SaleItem.objects.all()
+            group_by = ('department',)
+            annotations = {'revenue': Sum('price'), 'items': Count('id')}
+            aggregates = {'revenue': Sum('price')}
+        self.assertEqual(['department', 'items', 'revenue'], DepartmentReport().labels)
+        with self.assertNumQueries(2):
+            rows, aggregates = DepartmentReport().get_rows()
+            rows = list(rows)
+        self.assertEqual([(u'100%', 1, revenue(department=u'100%')),
+                          (u'Mens', len(items) - 3, revenue(department=u'Mens')),
+                          (u"Women's", 2, revenue(department=u"Women's"))], rows)
+        self.assertEqual([('total', 3), ('revenue', revenue())], resolve_aggregates(aggregates))
+        rows, aggregates = DepartmentReport().get_rows(order_by='-items')
+        self.assertEqual(u'Mens', list(rows)[0][0])
+        # pivoting the departments into columns, escaped into the SQL
+        class SizeReport(DepartmentReport):
+            group_by = ('option2',)
+            annotations = {'revenue': Sum('price')}
+            pivot = 'department'
+            pivot_values = ('Mens', (u"Women's", 'Womens'), u'100%')
+        self.assertEqual(['option2', 'Mens', 'Womens', u'100%'], SizeReport().labels)
+        rows, aggregates = SizeReport().get_rows({'option2__in': ['Small', 'Medium']})
+        self.assertEqual([('Medium',) + tuple(revenue(option2='Medium', department=d) for d in ('Mens', u"Women's", u'100%')),
+                          ('Small',) + tuple(revenue(option2='Small', department=d) for d in ('Mens', u"Women's", u'100%'))],
+                         list(rows))
+        # pivots follow relations
+        class CustomerReport(DepartmentReport):
+            pivot = 'sale__customer__id'
+            pivot_values = (sale.customer_id,)
+        self.assertEqual(['department', '%s items' % sale.customer_id, '%s revenue' % sale.customer_id],
+                         CustomerReport().labels)
+        rows = dict((row[0], row[1:]) for row in CustomerReport().get_rows()[0])
+        self.assertEqual((2, revenue(department=u"Women's")), rows[u"Women's"])
+        self.assertEqual(len([i for i in items if i.department == u'Mens' and i.sale_id == sale.pk]), rows[u'Mens'][0])
+
+    def test_generate_report_lazy_total(self):
+        import csv
+        import tempfile
+        from django.core.management import call_command
+        from xml.dom import minidom
+        count = models.SaleItem.objects.count()
+        path = tempfile.mktemp()
+        class ExportSaleItemReport(SaleItemReport):
+            output_formats = SaleItemReport.output_formats + [XMLOutputFormat()]
+        reportengine._registry[('testing', 'sale-items')] = ExportSaleItemReport
+        try:
+            call_command('generate_report', namespace='testing', report='sale-items', format='csv', file=path)
+            lines = list(csv.reader(open(path)))
+            self.assertEqual(['total', str(count)], lines[0])
+            self.assertEqual(count, len(lines) - 2)
+            call_command('generate_report', namespace='testing', report='sale-items', format='json', file=path)
+            self.assertEqual([['total', count]], json.load(open(path))['aggregates'])
+            call_command('generate_report', namespace='testing', report='sale-items', format='xml', file=path)
+            aggregate = minidom.parse(path).documentElement.firstChild
+            self.assertEqual(('total', str(count)), (aggregate.getAttribute('name'), aggregate.firstChild.data))
+            if XLS_AVAILABLE:
+                call_command('generate_report', namespace='testing', report='sale-items', format='xls', file=path)
+            # formats a report doesn't offer fall back to CSV (or XLS with xlwt), whatever other formats are available
+            reportengine._registry[('testing', 'sale-items')] = SaleItemReport
+            call_command('generate_report', namespace='testing', report='sale-items', format='nonexistent', file=path)
+            data = open(path, 'rb').read()
+            if XLS_AVAILABLE:
+                self.assertTrue(data.startswith('\xd0\xcf\x11\xe0'))
+            else:
+                self.assertEqual(['total', str(count)], list(csv.reader(data.splitlines()))[0])
+        finally:
+            del reportengine._registry[('testing', 'sale-items')]
+            os.remove(path)
+        rows, aggregates = SaleItemReport().get_rows()
+        self.assertEqual(str(count), str(aggregates[0][1]))
+        self.assertEqual(float(count), float(aggregates[0][1]))
+
+    def test_typed_exports_from_stored_rows(self):
+        from reportengine.models import ReportRequest, ReportRequestExport
+        class TypedSaleItemReport(SaleItemReport):
+            labels = ('name', 'price', 'sale__purchase_date')
+        rr = ReportRequest.objects.create(token='typed', namespace='testing', slug='typed', params={})
+        rr.get_report = lambda: TypedSaleItemReport()
+        rr.build_report()
+        item = models.SaleItem.objects.order_by('pk')[0]
+        # stored as JSON, so the decimals and dates are kept as strings
+        self.assertTrue(isinstance(list(rr.get_result_store().get_rows())[0][1], basestring))
+        export = ReportRequestExport(report_request=rr, format='json', token='typedjson')
+        context = export.get_output_context(TypedSaleItemReport())
+        row = list(context['rows'])[0]
+        self.assertEqual([item.name, item.price], row[:2])
+        purchase_date = item.sale.purchase_date
+        # DjangoJSONEncoder keeps milliseconds
+        self.assertEqual(purchase_date.replace(microsecond=purchase_date.microsecond // 1000 * 1000), row[2])
+        data = json.loads(''.join(JSONOutputFormat().iter_output(context)))
+        self.assertEqual(float(item.price), data['rows'][0][1])
+        if PARQUET_AVAILABLE:
+            import pyarrow
+            import pyarrow.parquet
+            from cStringIO import StringIO
+            context = export.get_output_context(TypedSaleItemReport())
+            table = pyarrow.parquet.read_table(StringIO(''.join(ParquetOutputFormat().iter_output(context))))
+            self.assertEqual([pyarrow.string(), pyarrow.float64(), pyarrow.timestamp('us')],
+                             [field.type for field in table.schema])
+
+    @skipUnless(timezone, 'Django < 1.4 has no time zone support')
+    def test_typed_exports_use_tz(self):
+        from django.test.utils import override_settings
+        from reportengine.models import ReportRequest, ReportRequestExport
+        from reportengine.outputformats import XLSOutputFormat
+        from cStringIO import StringIO
+        stamp = timezone.make_aware(datetime(2013, 1, 2, 3, 4, 5), timezone.utc)
+        class StampReport(reportengine.base.Report):
+            labels = ('stamp',)
+            column_types = {'stamp': 'datetime'}
+            def get_rows(self, *args, **kwargs):
+                return [(stamp,), ('not a date',), ('2013-02-30T00:00:00',)], ()
+        with override_settings(USE_TZ=True):
+            rr = ReportRequest.objects.create(token='stamps', namespace='testing', slug='stamps', params={})
+            rr.get_report = lambda: StampReport()
+            rr.build_report()
+            # stored with its offset
+            self.assertTrue(list(rr.get_result_store().get_rows())[0][0].endswith('Z'))
+            export = ReportRequestExport(report_request=rr, format='xls', token='stampsxls')
+            context = export.get_output_context(StampReport())
+            # local time, and strings that aren't datetimes are kept
+            self.assertEqual([[timezone.make_naive(stamp, timezone.get_current_timezone())], ['not a date'],
+                              ['2013-02-30T00:00:00']], list(context['rows']))
+            if XLS_AVAILABLE:
+                XLSOutputFormat().generate_output(export.get_output_context(StampReport()), StringIO())